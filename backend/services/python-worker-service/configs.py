@@ -7,10 +7,23 @@ from botocore.client import BaseClient
 
 # Environment Variables
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-COLLECTION_ID_JOBS = os.getenv("COLLECTION_ID_JOBS") 
+COLLECTION_ID_JOBS = os.getenv("COLLECTION_ID_JOBS")
 DEFAULT_EXECUTION_TIMEOUT_SEC = int(os.getenv("DEFAULT_EXECUTION_TIMEOUT_SEC", "30"))
 LOG_LEVEL = os.getenv("LOG_LEVEL")
 
+# When enabled, the worker answers Cloud Tasks before flushing the final job
+# document to Firestore (the write runs as a background task). Frees the task
+# slot one Firestore RTT sooner, at the cost that a crash between response and
+# write loses the result - hence opt-in, default off.
+DEFER_FINAL_WRITE = os.getenv("DEFER_FINAL_WRITE", "false").lower() in ("1", "true", "yes")
+
+# Root for per-job workspace directories. Prefer a tmpfs mount so downloaded
+# workspace files land in RAM instead of disk and rmtree on cleanup is cheap;
+# fall back to the platform default (/tmp) when no tmpfs is available.
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT", "/dev/shm")
+if not os.path.isdir(WORKSPACE_ROOT):
+    WORKSPACE_ROOT = None  # tempfile falls back to its default temp dir
+
 # R2/S3 Environment Variables
 R2_ACCOUNT_ID = os.getenv('R2_ACCOUNT_ID')
 R2_ACCESS_KEY_ID = os.getenv('R2_ACCESS_KEY_ID')
@@ -20,40 +33,79 @@ R2_BUCKET_NAME = os.getenv('R2_BUCKET_NAME')
 # Global clients - to be initialized by functions below
 firestore_client: google_firestore.Client | None = None
 s3_client: BaseClient | None = None  # Use BaseClient for the s3_client type hint
+# Jobs CollectionReference, cached once at init so request handlers don't
+# rebuild it (client.collection() allocates a fresh reference every call).
+jobs_collection: google_firestore.CollectionReference | None = None
 
 # Configure logging
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def set_execution_limits(cpu_time_sec: int = 10, memory_mb: int = 256, max_processes: int = 1, max_file_size_mb: int = 10):
+# Sandbox limits, precomputed once at import: (resource id, (soft, hard)).
+# set_execution_limits runs post-fork in the child via preexec_fn, so keeping
+# its body to a bare loop over a frozen tuple avoids redundant kwarg evaluation
+# and arithmetic on every spawn.
+_MB = 1024 * 1024
+EXECUTION_RLIMITS = (
+    (resource.RLIMIT_CPU, (10, 10)),          # seconds of CPU time
+    (resource.RLIMIT_AS, (256 * _MB,) * 2),   # address space
+    # RLIMIT_NPROC counts every process owned by the uid, not just the
+    # sandboxed child. With the worker, pooled interpreters, and concurrent
+    # jobs sharing one uid, a limit of 1 makes execve/fork fail with EAGAIN
+    # under load, turning good jobs into spurious internal errors. 16 still
+    # stops fork bombs while leaving headroom for normal concurrency.
+    (resource.RLIMIT_NPROC, (16, 16)),        # processes (per uid)
+    (resource.RLIMIT_FSIZE, (10 * _MB,) * 2), # file size
+)
+
+def set_execution_limits():
     try:
-        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time_sec, cpu_time_sec))
-        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, memory_mb * 1024 * 1024))
-        resource.setrlimit(resource.RLIMIT_NPROC, (max_processes, max_processes))
-        resource.setrlimit(resource.RLIMIT_FSIZE, (max_file_size_mb * 1024 * 1024, max_file_size_mb * 1024 * 1024))
+        for limit_id, bounds in EXECUTION_RLIMITS:
+            resource.setrlimit(limit_id, bounds)
     except Exception as e:
         logger.warning(f"Failed to set some resource limits (expected on some platforms): {e}")
 
+def apply_execution_limits(pid: int):
+    """Apply the same sandbox limits as set_execution_limits, but from the parent.
+
+    Passing preexec_fn forces CPython off the posix_spawn fast path onto a full
+    fork+exec with a Python callback in the child. Setting the limits from the
+    parent via prlimit() right after spawn keeps the fast path. The child runs
+    unlimited for the few microseconds between spawn and prlimit, which is fine:
+    it is still busy with interpreter startup at that point.
+    """
+    try:
+        for limit_id, bounds in EXECUTION_RLIMITS:
+            resource.prlimit(pid, limit_id, bounds)
+    except Exception as e:
+        logger.warning(f"Failed to apply some resource limits to pid {pid}: {e}")
+
 def get_firestore_client() -> google_firestore.Client | None:
     return firestore_client
 
 def get_s3_client() -> BaseClient | None:  # Use BaseClient for the return type hint
     return s3_client
 
+def get_jobs_collection() -> google_firestore.CollectionReference | None:
+    return jobs_collection
+
 def init_clients():
-    global firestore_client, s3_client
+    global firestore_client, s3_client, jobs_collection
 
     # Initialize Firestore
     if GCP_PROJECT_ID:
         try:
             firestore_client = google_firestore.Client(project=GCP_PROJECT_ID)
+            jobs_collection = firestore_client.collection(COLLECTION_ID_JOBS)
             logger.info("Firestore client initialized.")
         except Exception as e:
             logger.critical(f"Failed to initialize Firestore client: {e}", exc_info=True)
             firestore_client = None # Ensure it's None on failure
+            jobs_collection = None
     else:
         logger.critical("GCP_PROJECT_ID environment variable not set. Firestore client NOT initialized.")
         firestore_client = None
+        jobs_collection = None
 
     # Initialize S3 client for R2
     if R2_ACCOUNT_ID and R2_ACCESS_KEY_ID and R2_SECRET_ACCESS_KEY:
@@ -68,7 +120,12 @@ def init_clients():
                 region_name="auto",
                 config=boto3.session.Config(
                     signature_version='s3v4',
-                    s3={'addressing_style': 'path'}
+                    s3={'addressing_style': 'path'},
+                    # Workspace downloads run concurrently; the default pool of
+                    # 10 connections forces fresh TLS handshakes beyond that.
+                    max_pool_connections=64,
+                    tcp_keepalive=True,
+                    retries={'max_attempts': 3, 'mode': 'standard'}
                 )
             )
             logger.info("Boto3 S3 client for R2 initialized.")
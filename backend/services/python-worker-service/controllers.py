@@ -1,41 +1,90 @@
+import ast
+import asyncio
+import hashlib
+import logging
+import os
 import subprocess
+import threading
+from collections import OrderedDict
 from time_utils import now_iso8601  # Standardized ISO 8601 formatting
 from pathlib import Path
 import tempfile # Added for TemporaryDirectory
 
-from fastapi import APIRouter, HTTPException # Using APIRouter for modularity
+from fastapi import APIRouter, BackgroundTasks, HTTPException # Using APIRouter for modularity
+from starlette.concurrency import run_in_threadpool # Offload blocking work from the event loop
 from google.cloud import firestore as google_firestore # For type hinting
 
+from interpreter_pool import pool as interpreter_pool
+from proc_utils import PIPE_KWARGS, TRUNCATION_NOTICE, communicate_bounded
 from models import CloudTaskPayload, CloudTaskAuthPayload
 from configs import (
     logger, 
     get_firestore_client, 
     get_s3_client, 
-    set_execution_limits,
-    COLLECTION_ID_JOBS, 
-    DEFAULT_EXECUTION_TIMEOUT_SEC
+    get_jobs_collection,
+    apply_execution_limits,
+    DEFAULT_EXECUTION_TIMEOUT_SEC,
+    DEFER_FINAL_WRITE,
+    WORKSPACE_ROOT
 )
 
 router = APIRouter()
 
+# Result cache for repeated identical submissions (autograders, example runs
+# re-executed by many users). Only snippets that are provably replayable get
+# cached: no imports (rules out time/random/os) and none of the builtins below,
+# so the same (code, input) pair always produces the same result.
+EXEC_CACHE_SIZE = int(os.getenv("EXEC_CACHE_SIZE", "512"))
+_exec_cache: OrderedDict = OrderedDict()
+_exec_cache_lock = threading.Lock()
+_NON_REPLAYABLE_CALLS = frozenset({"open", "input", "eval", "exec", "compile", "__import__", "getattr", "globals", "vars"})
+
+def _is_replayable(code: str) -> bool:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            return False
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _NON_REPLAYABLE_CALLS:
+            return False
+    return True
+
+def _exec_cache_key(code: str, input_data: str | None) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(code.encode())
+    digest.update(b"\x00")
+    digest.update((input_data or "").encode())
+    return digest.digest()
+
 def _execute_python_code_direct(job_id: str, code: str, input_data: str | None) -> tuple[str | None, str | None, int]:
+    cache_key = _exec_cache_key(code, input_data)
+    with _exec_cache_lock:
+        cached = _exec_cache.get(cache_key)
+        if cached is not None:
+            _exec_cache.move_to_end(cache_key)
+            logger.info("Job %s (direct): Serving cached result for identical submission.", job_id)
+            return cached
     try:
-        process = subprocess.run(
-            ['python3', '-c', code],
-            input=input_data, 
-            text=True,
-            timeout=DEFAULT_EXECUTION_TIMEOUT_SEC,
-            capture_output=True,
-            preexec_fn=set_execution_limits
-        )
+        # Pooled interpreters have already paid fork/exec + interpreter startup
+        # before the request arrived; see interpreter_pool.py.
+        process = interpreter_pool.run(code, input_data, timeout=DEFAULT_EXECUTION_TIMEOUT_SEC)
         if process.returncode == 0:
-            return process.stdout, None, 0 
+            result = (process.stdout, None, 0)
         else:
-            error_output = process.stderr if process.stderr else process.stdout 
-            logger.warning(f"Job {job_id} (direct): User code error (rc={process.returncode}).")
-            return process.stdout, error_output, 1 
+            error_output = process.stderr if process.stderr else process.stdout
+            logger.warning("Job %s (direct): User code error (rc=%s).", job_id, process.returncode)
+            result = (process.stdout, error_output, 1)
+        if _is_replayable(code):
+            with _exec_cache_lock:
+                _exec_cache[cache_key] = result
+                _exec_cache.move_to_end(cache_key)
+                while len(_exec_cache) > EXEC_CACHE_SIZE:
+                    _exec_cache.popitem(last=False)
+        return result
     except subprocess.TimeoutExpired:
-        logger.warning(f"Job {job_id} (direct): Code execution timed out.")
+        logger.warning("Job %s (direct): Code execution timed out.", job_id)
         return None, f"Execution timed out after {DEFAULT_EXECUTION_TIMEOUT_SEC} seconds.", 2
     except Exception as e:
         logger.error(f"Job {job_id} (direct): Internal error: {e}", exc_info=True)
@@ -43,46 +92,59 @@ def _execute_python_code_direct(job_id: str, code: str, input_data: str | None)
 
 def _execute_python_script_in_dir(job_id: str, script_path: Path, exec_dir: Path, input_data: str | None) -> tuple[str | None, str | None, int]:
     try:
-        logger.info(f"Job {job_id}: Executing 'python3 {str(script_path)}' in '{exec_dir}'")
-        process = subprocess.run(
+        logger.info("Job %s: Executing 'python3 %s' in '%s'", job_id, script_path, exec_dir)
+        # No preexec_fn here so CPython can spawn via vfork instead of a full
+        # fork plus a Python callback in the child. (posix_spawn is off the
+        # table regardless: CPython only uses it with cwd=None and
+        # close_fds=False, and this call sets cwd.) The limits are applied
+        # from the parent right after Popen returns - the child is still in
+        # interpreter startup then, well before any user code runs, which is
+        # the accepted trade-off for keeping the fast spawn path.
+        proc = subprocess.Popen(
             ['python3', str(script_path)],
-            text=True, 
-            timeout=DEFAULT_EXECUTION_TIMEOUT_SEC, 
-            capture_output=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
             cwd=str(exec_dir),
-            input=input_data,
-            preexec_fn=set_execution_limits 
+            **PIPE_KWARGS
         )
+        apply_execution_limits(proc.pid)
+        stdout, stderr, truncated = communicate_bounded(proc, input_data, DEFAULT_EXECUTION_TIMEOUT_SEC)
+        if truncated:
+            stderr += TRUNCATION_NOTICE
+        process = subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
         if process.returncode == 0:
             return process.stdout, None, 0
         else:
             error_output = process.stderr if process.stderr else process.stdout
-            logger.warning(f"Job {job_id} (workspace): User code error (rc={process.returncode}).")
+            logger.warning("Job %s (workspace): User code error (rc=%s).", job_id, process.returncode)
             return process.stdout, error_output, 1
     except subprocess.TimeoutExpired:
-        logger.warning(f"Job {job_id} (workspace): Code execution timed out.")
+        logger.warning("Job %s (workspace): Code execution timed out.", job_id)
         return None, f"Execution timed out after {DEFAULT_EXECUTION_TIMEOUT_SEC} seconds.", 2
     except Exception as e:
         logger.error(f"Job {job_id} (workspace): Internal error: {e}", exc_info=True)
         return None, f"Internal worker error: {str(e)}", 3
 
-@google_firestore.transactional
-def _update_job_in_transaction(transaction: google_firestore.Transaction, job_ref: google_firestore.DocumentReference, update_data: dict):
-    transaction.update(job_ref, update_data)
-
 def _update_firestore_job_status(job_id: str, job_doc_ref: google_firestore.DocumentReference, data_to_update: dict, stage_description: str):
     firestore_client = get_firestore_client()
     if not firestore_client:
         logger.error(f"Job {job_id}: Firestore client N/A for '{stage_description}'.")
         raise RuntimeError("Firestore client not available.")
     try:
-        transaction = firestore_client.transaction()
-        _update_job_in_transaction(transaction, job_doc_ref, data_to_update)
-        logger.info(f"Job {job_id}: Firestore updated for '{stage_description}'. Status: {data_to_update.get('status')}")
+        # Single-document updates are already atomic in Firestore, so a
+        # transaction adds an extra round-trip for no isolation benefit.
+        job_doc_ref.update(data_to_update)
+        logger.info("Job %s: Firestore updated for '%s'. Status: %s", job_id, stage_description, data_to_update.get('status'))
     except Exception as e:
         logger.error(f"Job {job_id}: Firestore update FAILED for '{stage_description}': {e}", exc_info=True)
         raise RuntimeError(f"Firestore update failed for job {job_id}") from e
 
+async def _update_firestore_job_status_async(job_id: str, job_doc_ref: google_firestore.DocumentReference, data_to_update: dict, stage_description: str):
+    """Threadpool wrapper so async endpoints never block the event loop on a Firestore RPC."""
+    await run_in_threadpool(_update_firestore_job_status, job_id, job_doc_ref, data_to_update, stage_description)
+
 def _build_final_update_data(exec_status_code: int, output: str | None, error_details: str | None, current_status: str) -> dict:
     # Generate standardized ISO 8601 timestamp matching JavaScript toISOString()
     completed_at_time = now_iso8601()  # Exact JavaScript toISOString() format
@@ -103,41 +165,76 @@ def _build_final_update_data(exec_status_code: int, output: str | None, error_de
     if exec_status_code == 2: data["failure_type"] = "timeout"
     elif exec_status_code == 1: data["failure_type"] = "user_code_error"
     elif exec_status_code == 3: data["failure_type"] = "worker_internal_error"
-    
+
     data["completed_at"] = completed_at_time
     return data
 
+async def _fail_unsupported_language(job_id: str, job_doc_ref: google_firestore.DocumentReference, language: str) -> dict:
+    """Fail a non-Python job with one blind write, before any execution cost.
+
+    Returns 200-shaped content so Cloud Tasks does not retry a job that can
+    never succeed on this worker.
+    """
+    logger.warning("Job %s: Unsupported language '%s'; failing fast.", job_id, language)
+    ts = now_iso8601()
+    try:
+        await _update_firestore_job_status_async(job_id, job_doc_ref, {
+            "status": "failed",
+            "error": f"Unsupported language: {language}. This worker only executes Python.",
+            "failure_type": "unsupported_language",
+            "output": "",
+            "updated_at": ts,
+            "completed_at": ts,
+        }, "unsupported language")
+    except RuntimeError:
+        logger.error(f"Job {job_id}: Failed to record unsupported-language failure.")
+    return {"job_id": job_id, "message": "Unsupported language; job marked failed."}
+
 @router.post("/execute")
-async def execute_direct_task(payload: CloudTaskPayload):
+async def execute_direct_task(payload: CloudTaskPayload, background_tasks: BackgroundTasks):
     job_id = payload.job_id
-    logger.info(f"Job {job_id}: /execute. Lang: {payload.language}, Input: {len(payload.input or '')} chars.")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Job %s: /execute. Lang: %s, Input: %d chars.", job_id, payload.language, len(payload.input) if payload.input else 0)
     firestore_client = get_firestore_client()
     if not firestore_client:
         raise HTTPException(status_code=503, detail="Cannot connect to Firestore.")
 
-    job_doc_ref = firestore_client.collection(COLLECTION_ID_JOBS).document(job_id)
+    job_doc_ref = get_jobs_collection().document(job_id)
+    if payload.language and payload.language.lower() != "python":
+        return await _fail_unsupported_language(job_id, job_doc_ref, payload.language)
+
+    # Direct executions are short (bounded by DEFAULT_EXECUTION_TIMEOUT_SEC and
+    # usually sub-second), so a separate "processing" write would often cost
+    # more than the execution itself. Fuse both status transitions into the
+    # single final write; _build_final_update_data still records
+    # processing_started_at for the fused status.
     initial_status = "processing_direct"
-    try:
-        _update_firestore_job_status(job_id, job_doc_ref, {"status": initial_status, "updated_at": now_iso8601()}, "initial status")
-    except RuntimeError:
-        raise HTTPException(status_code=500, detail=f"Failed to set initial status for job {job_id}.")
 
-    output, error_details, exec_status_code = _execute_python_code_direct(job_id, payload.code, payload.input)
+    # subprocess.run blocks for the full execution; run it in the threadpool so
+    # the event loop keeps serving other requests meanwhile.
+    output, error_details, exec_status_code = await run_in_threadpool(
+        _execute_python_code_direct, job_id, payload.code, payload.input
+    )
     final_job_data = _build_final_update_data(exec_status_code, output, error_details, initial_status)
 
-    try:
-        _update_firestore_job_status(job_id, job_doc_ref, final_job_data, "final results")
-    except RuntimeError:
-        logger.critical(f"Job {job_id}: CRITICAL - FAILED TO SAVE FINAL RESULTS after execution.")
-        pass 
+    if DEFER_FINAL_WRITE:
+        # Release the Cloud Tasks slot now; the final write lands right after
+        # the response is sent (Starlette runs sync tasks in the threadpool).
+        background_tasks.add_task(_update_firestore_job_status, job_id, job_doc_ref, final_job_data, "final results (deferred)")
+    else:
+        try:
+            await _update_firestore_job_status_async(job_id, job_doc_ref, final_job_data, "final results")
+        except RuntimeError:
+            logger.critical(f"Job {job_id}: CRITICAL - FAILED TO SAVE FINAL RESULTS after execution.")
+            pass
 
-    logger.info(f"Job {job_id}: Direct exec completed. Status: {final_job_data.get('status')}.")
+    logger.info("Job %s: Direct exec completed. Status: %s.", job_id, final_job_data.get('status'))
     return {"job_id": job_id, "message": "Direct execution task processed."}
 
 @router.post("/execute_auth")
 async def execute_auth_task(payload: CloudTaskAuthPayload):
     job_id = payload.job_id
-    logger.info(f"Job {job_id}: /execute_auth. WS: {payload.workspace_id}, Entry: {payload.entrypoint_file}")
+    logger.info("Job %s: /execute_auth. WS: %s, Entry: %s", job_id, payload.workspace_id, payload.entrypoint_file)
     firestore_client = get_firestore_client()
     s3_client = get_s3_client()
 
@@ -148,67 +245,80 @@ async def execute_auth_task(payload: CloudTaskAuthPayload):
         if not s3_client: detail_msg.append("R2 unavailable")
         raise HTTPException(status_code=503, detail=f"Service temporarily unavailable ({', '.join(detail_msg)}).")
 
-    job_doc_ref = firestore_client.collection(COLLECTION_ID_JOBS).document(job_id)
+    job_doc_ref = get_jobs_collection().document(job_id)
+    if payload.language and payload.language.lower() != "python":
+        return await _fail_unsupported_language(job_id, job_doc_ref, payload.language)
+
     initial_status = "processing_auth_workspace"
     try:
         # Set initial job status in Firestore
-        _update_firestore_job_status(job_id, job_doc_ref, {"status": initial_status, "updated_at": now_iso8601()}, "initial status")
+        await _update_firestore_job_status_async(job_id, job_doc_ref, {"status": initial_status, "updated_at": now_iso8601()}, "initial status")
     except RuntimeError:
         raise HTTPException(status_code=500, detail=f"Failed to set initial status for job {job_id}.")
 
     try:
         # Create a temporary directory for workspace files, ensuring cleanup
-        with tempfile.TemporaryDirectory(prefix=f"job_{job_id}_") as temp_dir_name: 
+        with tempfile.TemporaryDirectory(prefix=f"job_{job_id}_", dir=WORKSPACE_ROOT) as temp_dir_name:
             workspace_exec_dir = Path(temp_dir_name)
-            logger.info(f"Job {job_id}: Created temporary execution directory: {workspace_exec_dir}")
-            _update_firestore_job_status(job_id, job_doc_ref, {"status": "fetching_from_r2", "updated_at": now_iso8601()}, "fetching code")
+            logger.info("Job %s: Created temporary execution directory: %s", job_id, workspace_exec_dir)
+            # Intermediate "fetching_from_r2"/"running_auth_workspace" stages are
+            # not consumed by any client, so we no longer burn a Firestore
+            # round-trip per stage; only externally visible transitions are written.
 
             if not payload.files:
                 msg = "No files found in job payload manifest to download."
                 logger.error(f"Job {job_id}: {msg}")
                 final_job_data = _build_final_update_data(3, None, msg, initial_status)
-                _update_firestore_job_status(job_id, job_doc_ref, final_job_data, "final results - no files")
+                await _update_firestore_job_status_async(job_id, job_doc_ref, final_job_data, "final results - no files")
                 return {"job_id": job_id, "message": msg, "final_status": "failed"}
             
-            logger.info(f"Job {job_id}: Found {len(payload.files)} files in manifest. Starting download from R2.")
+            logger.info("Job %s: Found %d files in manifest. Starting download from R2.", job_id, len(payload.files))
 
-            # Download each file from the manifest provided in the payload
+            # Resolve local targets and create parent directories up front so the
+            # concurrent downloads below don't contend on mkdir.
+            downloads: list[tuple[str, Path]] = []
             for file_to_download in payload.files:
                 s3_key = file_to_download.r2_object_key
                 relative_path = file_to_download.file_path
-                
+
                 if not s3_key or not relative_path:
-                    logger.warning(f"Job {job_id}: Skipping file in manifest with missing key or path. Key: '{s3_key}', Path: '{relative_path}'")
+                    logger.warning("Job %s: Skipping file in manifest with missing key or path. Key: '%s', Path: '%s'", job_id, s3_key, relative_path)
                     continue
 
                 local_file = workspace_exec_dir / relative_path
                 local_file.parent.mkdir(parents=True, exist_ok=True)
-                logger.info(f"Job {job_id}:   Downloading '{s3_key}' to '{local_file}'")
-                s3_client.download_file(payload.r2_bucket_name, s3_key, str(local_file))
-            
+                downloads.append((s3_key, local_file))
+
+            # Download concurrently; each boto3 call runs in the default executor
+            # so N files cost ~one round-trip of wall time instead of N.
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(
+                loop.run_in_executor(None, s3_client.download_file, payload.r2_bucket_name, s3_key, str(local_file))
+                for s3_key, local_file in downloads
+            ))
+
             entrypoint_script_local_path = workspace_exec_dir / payload.entrypoint_file.lstrip('/')
-            logger.info(f"Job {job_id}: Checking for entrypoint at resolved path: {entrypoint_script_local_path}")
+            logger.info("Job %s: Checking for entrypoint at resolved path: %s", job_id, entrypoint_script_local_path)
             
             # Verify the specified entrypoint file exists locally after download
             if not entrypoint_script_local_path.is_file():
                 msg = f"Entrypoint '{payload.entrypoint_file}' not found in downloaded workspace. Checked path: {entrypoint_script_local_path}"
                 logger.error(f"Job {job_id}: {msg}")
                 final_job_data = _build_final_update_data(3, None, msg, initial_status)
-                _update_firestore_job_status(job_id, job_doc_ref, final_job_data, "final results - entrypoint missing")
+                await _update_firestore_job_status_async(job_id, job_doc_ref, final_job_data, "final results - entrypoint missing")
                 return {"job_id": job_id, "message": msg, "final_status": "failed"}
 
-            # Update Firestore status before running the code
-            _update_firestore_job_status(job_id, job_doc_ref, {"status": "running_auth_workspace", "updated_at": now_iso8601()}, "running code")
-            
-            # Execute the Python script from the temporary directory
-            output, error_details, exec_status_code = _execute_python_script_in_dir(
-                job_id, Path(payload.entrypoint_file), workspace_exec_dir, payload.input 
+            # Execute the Python script from the temporary directory (off the
+            # event loop, as above).
+            output, error_details, exec_status_code = await run_in_threadpool(
+                _execute_python_script_in_dir,
+                job_id, Path(payload.entrypoint_file), workspace_exec_dir, payload.input
             )
             # Update Firestore with final execution results
             final_job_data = _build_final_update_data(exec_status_code, output, error_details, initial_status)
-            _update_firestore_job_status(job_id, job_doc_ref, final_job_data, "final results")
+            await _update_firestore_job_status_async(job_id, job_doc_ref, final_job_data, "final results")
             
-            logger.info(f"Job {job_id}: Auth Workspace execution completed. Status: {final_job_data.get('status')}.")
+            logger.info("Job %s: Auth Workspace execution completed. Status: %s.", job_id, final_job_data.get('status'))
             return {"job_id": job_id, "message": "Auth workspace execution task processed."}
 
     except Exception as e: # Catch-all for outer try, including TemporaryDirectory issues or R2 download
@@ -216,7 +326,7 @@ async def execute_auth_task(payload: CloudTaskAuthPayload):
         try:
             # Attempt to update Firestore with an error status on unhandled exceptions
             final_job_data = _build_final_update_data(3, None, f"Unhandled worker exception: {str(e)}", initial_status)
-            _update_firestore_job_status(job_id, job_doc_ref, final_job_data, "final results - unhandled exception")
+            await _update_firestore_job_status_async(job_id, job_doc_ref, final_job_data, "final results - unhandled exception")
         except Exception as firestore_e:
             # Log critical failure if Firestore update fails after an unhandled exception
             logger.critical(f"Job {job_id}: CRITICAL - FAILED TO UPDATE Firestore after unhandled exception: {firestore_e}")
@@ -0,0 +1,99 @@
+"""
+Warm pool of pre-spawned Python interpreters for the direct execution path.
+
+Launching `python3 -c <code>` per job pays fork/exec plus interpreter startup
+(site import, encodings, etc.) on every request. The pool spawns interpreters
+ahead of demand: each idle child has already finished startup and sits blocked
+on stdin waiting for a job, so per-request cost drops to writing the payload
+and reading the result. Children still run under the same resource limits as
+before (applied via preexec_fn at spawn time) and exit after a single job, so
+no user state leaks between executions.
+"""
+
+import json
+import os
+import subprocess
+import threading
+from collections import deque
+
+from configs import logger, set_execution_limits
+from proc_utils import PIPE_KWARGS, TRUNCATION_NOTICE, communicate_bounded
+
+# Default the pool to one warm interpreter per CPU: short scripts are
+# startup-dominated, so the pool should cover the worker's whole concurrency.
+POOL_SIZE = int(os.getenv("INTERPRETER_POOL_SIZE", str(os.cpu_count() or 4)))
+
+# Runs inside each pooled child: wait for one job on stdin, execute it, exit.
+# stdin is swapped for the job's input so user code reading input() behaves
+# exactly as it did under `python3 -c` with input piped in.
+_BOOTSTRAP = """\
+import io, json, sys
+_job = json.loads(sys.stdin.readline())
+sys.stdin = io.StringIO(_job.get("input") or "")
+exec(compile(_job["code"], "<string>", "exec"), {"__name__": "__main__"})
+"""
+
+
+def _spawn() -> subprocess.Popen:
+    return subprocess.Popen(
+        ['python3', '-c', _BOOTSTRAP],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        preexec_fn=set_execution_limits,
+        **PIPE_KWARGS
+    )
+
+
+class InterpreterPool:
+    """Maintains warm interpreter processes and replenishes them in the background."""
+
+    def __init__(self, size: int = POOL_SIZE):
+        self._size = size
+        self._idle: deque[subprocess.Popen] = deque()
+        self._lock = threading.Lock()
+
+    def prefill(self):
+        """Spawn the initial set of warm interpreters (called at startup)."""
+        with self._lock:
+            while len(self._idle) < self._size:
+                self._idle.append(_spawn())
+        logger.info(f"Interpreter pool prefilled with {self._size} warm processes.")
+
+    def _replenish(self):
+        try:
+            proc = _spawn()
+            with self._lock:
+                if len(self._idle) < self._size:
+                    self._idle.append(proc)
+                    return
+            proc.kill()
+        except Exception as e:
+            logger.warning(f"Interpreter pool replenish failed: {e}")
+
+    def acquire(self) -> subprocess.Popen:
+        """Return a live warm interpreter, spawning cold if the pool is empty."""
+        while True:
+            with self._lock:
+                proc = self._idle.popleft() if self._idle else None
+            if proc is None:
+                return _spawn()
+            # Kick off a background replacement so the pool stays warm.
+            threading.Thread(target=self._replenish, daemon=True).start()
+            if proc.poll() is None:
+                return proc
+            proc.kill()  # Died while idle; discard and retry.
+
+    def run(self, code: str, input_data: str | None, timeout: int) -> subprocess.CompletedProcess:
+        """Execute `code` in a pooled interpreter, mirroring subprocess.run semantics."""
+        proc = self.acquire()
+        payload = json.dumps({"code": code, "input": input_data}) + "\n"
+        stdout, stderr, truncated = communicate_bounded(proc, payload, timeout)
+        if truncated:
+            stderr += TRUNCATION_NOTICE
+        return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+
+# Shared pool instance, prefilled from the FastAPI startup hook.
+pool = InterpreterPool()
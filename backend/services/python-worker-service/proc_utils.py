@@ -0,0 +1,85 @@
+"""
+Process I/O helpers shared by the interpreter pool and the workspace runner.
+"""
+
+import os
+import subprocess
+import sys
+import threading
+
+# Default Linux pipes hold 64KB; user code producing more than that blocks on
+# write until we drain, inflating wall time for chatty programs. 1MB pipes let
+# most outputs complete without cross-process ping-pong. `pipesize` is only
+# supported on Python 3.10+ (Linux), so fall back to defaults elsewhere.
+PIPE_KWARGS = {"pipesize": 1 << 20} if sys.version_info >= (3, 10) and sys.platform == "linux" else {}
+
+# Cap on captured stdout/stderr per stream. Anything beyond this can't be
+# stored in the job document anyway (Firestore caps documents at ~1MB), so
+# runaway printers get killed instead of ballooning worker memory.
+MAX_OUTPUT_CHARS = int(os.getenv("MAX_OUTPUT_CHARS", str(1 << 20)))
+
+TRUNCATION_NOTICE = f"\n[output truncated: exceeded {MAX_OUTPUT_CHARS} characters]"
+
+
+def _pump(proc: subprocess.Popen, stream, sink: list, state: dict):
+    """Read a stream into `sink` up to MAX_OUTPUT_CHARS, then kill and drain."""
+    try:
+        while True:
+            chunk = stream.read(65536)
+            if not chunk:
+                break
+            if state["truncated"]:
+                continue  # keep draining so the dying child can flush and exit
+            remaining = MAX_OUTPUT_CHARS - state["captured"]
+            sink.append(chunk[:remaining])
+            state["captured"] += len(chunk)
+            if state["captured"] > MAX_OUTPUT_CHARS:
+                state["truncated"] = True
+                proc.kill()
+    except Exception:
+        pass  # stream closed during kill; whatever was captured stands
+
+
+def _feed_stdin(proc: subprocess.Popen, input_data: str | None):
+    try:
+        if input_data:
+            proc.stdin.write(input_data)
+        proc.stdin.close()
+    except (BrokenPipeError, OSError):
+        pass  # child exited or stopped reading; matches communicate() behavior
+
+
+def communicate_bounded(proc: subprocess.Popen, input_data: str | None, timeout: int) -> tuple[str, str, bool]:
+    """Like proc.communicate(), but caps each captured stream at MAX_OUTPUT_CHARS.
+
+    A child that exceeds the cap is killed and its output truncated (flagged in
+    the returned bool). Raises subprocess.TimeoutExpired on timeout, with the
+    child already killed, mirroring the subprocess.run contract callers expect.
+    """
+    out_chunks: list[str] = []
+    err_chunks: list[str] = []
+    out_state = {"captured": 0, "truncated": False}
+    err_state = {"captured": 0, "truncated": False}
+
+    threads = [
+        threading.Thread(target=_pump, args=(proc, proc.stdout, out_chunks, out_state), daemon=True),
+        threading.Thread(target=_pump, args=(proc, proc.stderr, err_chunks, err_state), daemon=True),
+        threading.Thread(target=_feed_stdin, args=(proc, input_data), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        for t in threads:
+            t.join(timeout=5)
+        raise
+
+    for t in threads:
+        t.join(timeout=5)
+
+    truncated = out_state["truncated"] or err_state["truncated"]
+    return "".join(out_chunks), "".join(err_chunks), truncated
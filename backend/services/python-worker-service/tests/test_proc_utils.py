@@ -0,0 +1,65 @@
+import subprocess
+import sys
+
+import pytest
+
+import proc_utils
+from proc_utils import PIPE_KWARGS, communicate_bounded
+
+
+def _spawn(code: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, '-c', code],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        **PIPE_KWARGS
+    )
+
+
+def test_captures_stdout():
+    proc = _spawn("print('hello world')")
+    stdout, stderr, truncated = communicate_bounded(proc, None, 10)
+    assert stdout == "hello world\n"
+    assert stderr == ""
+    assert truncated is False
+    assert proc.returncode == 0
+
+
+def test_feeds_stdin():
+    proc = _spawn("import sys; print(sys.stdin.read().upper())")
+    stdout, _, _ = communicate_bounded(proc, "abc", 10)
+    assert stdout == "ABC\n"
+
+
+def test_captures_stderr_and_returncode():
+    proc = _spawn("import sys; sys.stderr.write('boom'); sys.exit(3)")
+    stdout, stderr, truncated = communicate_bounded(proc, None, 10)
+    assert stdout == ""
+    assert "boom" in stderr
+    assert truncated is False
+    assert proc.returncode == 3
+
+
+def test_truncates_runaway_output_and_kills_child():
+    # Emit well past the cap, then sleep: if the child weren't killed on
+    # truncation, the trailing sleep would push this test to the timeout.
+    code = (
+        f"import sys, time\n"
+        f"sys.stdout.write('x' * {proc_utils.MAX_OUTPUT_CHARS + 100_000})\n"
+        f"sys.stdout.flush()\n"
+        f"time.sleep(30)\n"
+    )
+    proc = _spawn(code)
+    stdout, _, truncated = communicate_bounded(proc, None, 10)
+    assert truncated is True
+    assert len(stdout) <= proc_utils.MAX_OUTPUT_CHARS
+    assert proc.poll() is not None
+
+
+def test_timeout_raises_and_kills_child():
+    proc = _spawn("import time; time.sleep(30)")
+    with pytest.raises(subprocess.TimeoutExpired):
+        communicate_bounded(proc, None, 1)
+    assert proc.poll() is not None
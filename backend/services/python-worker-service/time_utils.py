@@ -3,8 +3,16 @@ Time utility functions for consistent ISO 8601 formatting across services.
 Ensures exact compatibility with JavaScript's toISOString() format.
 """
 
+import time
 from datetime import datetime, timezone
 
+# Timestamps are emitted on every Firestore update and many log lines, often
+# several within the same wall-clock second. Cache the formatted
+# "YYYY-MM-DDTHH:mm:ss" prefix per second so repeat calls only format the
+# millisecond suffix. Races between threads just recompute the same prefix.
+_last_second: int = -1
+_last_prefix: str = ""
+
 
 def now_iso8601() -> str:
     """
@@ -16,13 +24,13 @@ def now_iso8601() -> str:
     Returns:
         str: Current time in ISO 8601 format with millisecond precision
     """
-    # 1. Get current time in UTC
-    dt_utc = datetime.now(timezone.utc)
-    
-    # 2. Format to ISO 8601 string with milliseconds and 'Z'
-    # %f gives microseconds (6 digits), so we slice to get milliseconds (3 digits)
-    # We manually append 'Z' since strftime doesn't have direct UTC indicator
-    return dt_utc.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    global _last_second, _last_prefix
+    ns = time.time_ns()
+    second, remainder = divmod(ns, 1_000_000_000)
+    if second != _last_second:
+        _last_prefix = datetime.fromtimestamp(second, timezone.utc).isoformat(timespec='seconds')[:19]
+        _last_second = second
+    return f"{_last_prefix}.{remainder // 1_000_000:03d}Z"
 
 
 def datetime_to_iso8601(dt: datetime) -> str:
@@ -43,6 +51,6 @@ def datetime_to_iso8601(dt: datetime) -> str:
     else:
         # Convert to UTC
         dt_utc = dt.astimezone(timezone.utc)
-    
-    # Format with millisecond precision and 'Z' suffix
-    return dt_utc.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z' 
\ No newline at end of file
+
+    # Same fast C-level formatting as now_iso8601()
+    return dt_utc.isoformat(timespec='milliseconds').replace('+00:00', 'Z') 
\ No newline at end of file
@@ -1,14 +1,17 @@
 import os
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
 from configs import logger, init_clients, LOG_LEVEL # Import necessary items from configs
 from controllers import router as api_router # Import the router from controllers
+from interpreter_pool import pool as interpreter_pool # Warm interpreters for /execute
 
 app = FastAPI(
     title="Python Worker Service",
     description="Handles direct and R2-based code execution for Python.",
-    version="0.1.0"
+    version="0.1.0",
+    default_response_class=ORJSONResponse  # Rust JSON encoder; matters once outputs get large
 )
 
 @app.on_event("startup")
@@ -16,6 +19,7 @@ async def startup_event():
     logger.info("Starting up Python Worker Service...")
     init_clients() # Initialize Firestore and S3 clients from configs.py
     logger.info("Clients initialized (or initialization attempted).")
+    interpreter_pool.prefill() # Pay interpreter startup cost before the first job
 
 # Include the API routes
 app.include_router(api_router)
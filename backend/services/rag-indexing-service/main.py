@@ -1,15 +1,24 @@
+import codecs
+import hashlib
 import json
 import logging
 import os
-from typing import List, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional
 from contextlib import asynccontextmanager
 
 import boto3
+from botocore.config import Config as BotoConfig
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import lancedb
 import google.generativeai as genai
 from botocore.exceptions import ClientError
+from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +42,11 @@ r2_client = None
 lance_db = None
 lance_table = None
 
+# Per-workspace table handles, cached for the lifetime of the warm instance so
+# repeat indexing jobs skip lancedb.connect/open_table (and the FTS index
+# check) entirely.
+_workspace_tables: Dict[str, Any] = {}
+
 def load_config():
     """Load configuration from environment variables."""
     config.gcp_project_id = os.getenv("GCP_PROJECT_ID", "")
@@ -69,7 +83,14 @@ def init_r2_client():
         endpoint_url=f'https://{config.r2_account_id}.r2.cloudflarestorage.com',
         aws_access_key_id=config.r2_access_key_id,
         aws_secret_access_key=config.r2_secret_access_key,
-        region_name='auto'
+        region_name='auto',
+        config=BotoConfig(
+            # Downloads fan out across DOWNLOAD_CONCURRENCY threads; the
+            # default pool of 10 connections would force extra TLS handshakes.
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            retries={'max_attempts': 3, 'mode': 'adaptive'}
+        )
     )
     logger.info("R2 client initialized")
 
@@ -85,7 +106,15 @@ def get_workspace_table(workspace_id: str):
 
     The table is stored under the prefix `<workspace_id>/` inside the R2 bucket so that
     each workspace maintains its own isolated vector index.
+
+    Handles are cached per workspace: connect/open_table hit R2 for manifest
+    reads, which is pure overhead to repeat on every indexing job a warm
+    instance serves.
     """
+    cached = _workspace_tables.get(workspace_id)
+    if cached is not None:
+        return cached
+
     # Ensure LanceDB knows how to talk to Cloudflare R2 (S3-compatible)
     os.environ["AWS_ACCESS_KEY_ID"] = config.r2_access_key_id
     os.environ["AWS_SECRET_ACCESS_KEY"] = config.r2_secret_access_key
@@ -99,6 +128,14 @@ def get_workspace_table(workspace_id: str):
     # Try opening existing table; otherwise create it.
     try:
         table = db.open_table(config.lancedb_table_name)
+        # Tables created before chunk_id entered the schema lack the
+        # merge_insert key; backfill the column once on open. Old rows get ''
+        # - no real "<path>#<i>" source key ever matches it, so they fall to
+        # the by-source-delete clause the next time their file is re-indexed
+        # and are replaced by keyed rows.
+        if "chunk_id" not in table.schema.names:
+            logger.info(f"Migrating table for workspace {workspace_id}: adding chunk_id column")
+            table.add_columns({"chunk_id": "''"})
         # Ensure FTS index exists (no-op if already present)
         try:
             table.create_fts_index("content")
@@ -107,6 +144,7 @@ def get_workspace_table(workspace_id: str):
     except (FileNotFoundError, ValueError):
         import pyarrow as pa
         schema = pa.schema([
+            pa.field("chunk_id", pa.string()),  # "<file_path>#<chunk index>", merge_insert key
             pa.field("file_path", pa.string()),
             pa.field("content", pa.string()),
             pa.field("workspace_id", pa.string()),
@@ -119,6 +157,7 @@ def get_workspace_table(workspace_id: str):
         except Exception as e:
             logger.warning(f"FTS index creation failed for new workspace {workspace_id}: {e}")
 
+    _workspace_tables[workspace_id] = table
     return table
 
 @asynccontextmanager
@@ -143,6 +182,11 @@ app = FastAPI(title="RAG Indexing Service", lifespan=lifespan)
 
 class WorkerFile(BaseModel):
     r2_object_key: str
+    # file_path gets spliced into LanceDB predicates; quote_predicate_value
+    # escapes it wherever that happens. No character allow-list here: real
+    # repos contain paths like [workspaceId]/page.tsx or names with @, +, ~
+    # or unicode, and a model-level 422 would fail the whole indexing job
+    # over one of them.
     file_path: str
 
 class RagIndexingRequest(BaseModel):
@@ -150,6 +194,80 @@ class RagIndexingRequest(BaseModel):
     workspace_id: str
     files: List[WorkerFile]
 
+# Batching knobs: text-embedding-004 accepts up to 100 texts per request;
+# up to 8 embedding batches fly concurrently so multi-batch jobs pay
+# ~max(batch latency) instead of the serial sum; 16 concurrent R2 GETs keeps
+# downloads network-bound without exhausting the botocore connection pool.
+EMBED_BATCH_SIZE = 100
+EMBED_CONCURRENCY = 8
+DOWNLOAD_CONCURRENCY = 16
+
+# Splitters hoisted to module scope: building one compiles its separator
+# regexes, so constructing them per file (or per request) is wasted work on a
+# warm instance. Language-aware splitters break on def/class boundaries, which
+# embeds far better than mid-function cuts; everything else falls back to the
+# generic recursive splitter.
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+FALLBACK_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+SPLITTERS = {
+    ext: RecursiveCharacterTextSplitter.from_language(
+        language=lang, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+    )
+    for ext, lang in {
+        ".py": Language.PYTHON,
+        ".js": Language.JS,
+        ".jsx": Language.JS,
+        ".ts": Language.TS,
+        ".tsx": Language.TS,
+        ".go": Language.GO,
+        ".md": Language.MARKDOWN,
+    }.items()
+}
+
+# Below this row count a flat kNN scan is faster than an IVF_PQ probe and the
+# index build cost isn't worth paying. Above it, rebuild whenever the table
+# has roughly doubled since the last build so the partitioning stays sized to
+# the data without re-indexing on every job.
+ANN_INDEX_MIN_ROWS = int(os.getenv("ANN_INDEX_MIN_ROWS", "10000"))
+_ann_index_rows: Dict[str, int] = {}
+
+def maybe_create_vector_index(table, workspace_id: str):
+    """Create/refresh the IVF_PQ vector index and workspace scalar index after ingest.
+
+    Without a vector index, every query is an O(rows x 768) full scan; IVF_PQ
+    keeps query latency flat as workspaces grow. Failures are logged, not
+    raised - search still works unindexed, just slower.
+    """
+    try:
+        row_count = table.count_rows()
+        if row_count < max(ANN_INDEX_MIN_ROWS, 2 * _ann_index_rows.get(workspace_id, 0)):
+            return
+        table.create_index(
+            metric="cosine",
+            vector_column_name="vector",
+            num_partitions=max(1, int(row_count ** 0.5)),
+            num_sub_vectors=96,  # 768-d Gemini vectors / 8 bytes per sub-vector
+        )
+        table.create_scalar_index("workspace_id")
+        _ann_index_rows[workspace_id] = row_count
+        logger.info(f"Built IVF_PQ index for workspace {workspace_id} at {row_count} rows")
+    except Exception as e:
+        logger.warning(f"Vector index build skipped for workspace {workspace_id}: {e}")
+
+def quote_predicate_value(value: str) -> str:
+    """Quote a string for use in a LanceDB filter predicate (SQL-style '' escaping).
+
+    The only guard between user-controlled paths and the delete predicate:
+    a stray quote must never turn a scoped delete into a broadcast one.
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+def split_content(file_path: str, content: str) -> List[str]:
+    """Split file content into embedding-sized chunks using a splitter keyed by extension."""
+    ext = os.path.splitext(file_path)[1].lower()
+    return SPLITTERS.get(ext, FALLBACK_SPLITTER).split_text(content)
+
 def get_embedding(text: str) -> List[float]:
     """Generate embedding for text using Google Generative AI."""
     try:
@@ -163,66 +281,313 @@ def get_embedding(text: str) -> List[float]:
         logger.error(f"Failed to generate embedding: {e}")
         raise
 
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings for a batch of texts in a single API call."""
+    try:
+        result = genai.embed_content(
+            model="models/text-embedding-004",
+            content=texts,
+            task_type="retrieval_document"
+        )
+        return result['embedding']
+    except Exception as e:
+        logger.error(f"Failed to generate embeddings for batch of {len(texts)} texts: {e}")
+        raise
+
+# Embedding cache keyed by chunk content hash. Re-index jobs mostly carry
+# unchanged files (one edited file triggers a whole-workspace sync), so most
+# chunks hash to a vector we already computed. ~4096 x 768-float vectors caps
+# the cache around 25MB.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+_embed_cache: OrderedDict = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+def _embed_cache_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+def embed_cache_get(text: str) -> Optional[List[float]]:
+    key = _embed_cache_key(text)
+    with _embed_cache_lock:
+        vector = _embed_cache.get(key)
+        if vector is not None:
+            _embed_cache.move_to_end(key)
+        return vector
+
+def embed_cache_put(text: str, vector: List[float]):
+    key = _embed_cache_key(text)
+    with _embed_cache_lock:
+        _embed_cache[key] = vector
+        _embed_cache.move_to_end(key)
+        while len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+
+def get_embeddings_with_fallback(texts: List[str]) -> List[Optional[List[float]]]:
+    """Embed a batch; on batch failure retry each text individually.
+
+    One poison text (e.g. over the model's token limit) would otherwise fail
+    the whole 100-chunk batch. The fallback isolates it: good texts still get
+    vectors, failures come back as None for the caller to record.
+    """
+    try:
+        return get_embeddings(texts)
+    except Exception:
+        logger.warning(f"Batch embedding failed; retrying {len(texts)} texts individually")
+        results: List[Optional[List[float]]] = []
+        for text in texts:
+            try:
+                results.append(get_embedding(text))
+            except Exception as e:
+                logger.error(f"Embedding failed for a single text in fallback: {e}")
+                results.append(None)
+        return results
+
+# Files above this size are skipped outright: they are almost never hand-
+# written source, and embedding them would burn hundreds of chunks' worth of
+# API quota on minified bundles or data dumps.
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", str(2 * 1024 * 1024)))
+
+# Known-binary extensions, rejected before download: they can't be UTF-8
+# decoded or usefully embedded, so fetching them is pure wasted IO. A deny
+# list (rather than an allow list) keeps unusual-but-legitimate text files
+# like configs and lockfiles indexable.
+BINARY_EXTS = frozenset({
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp",
+    ".mp3", ".mp4", ".wav", ".avi", ".mov", ".webm", ".ogg",
+    ".zip", ".tar", ".gz", ".bz2", ".xz", ".7z", ".rar", ".jar",
+    ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+    ".woff", ".woff2", ".ttf", ".otf", ".eot",
+    ".so", ".dll", ".dylib", ".exe", ".bin", ".o", ".a", ".class", ".pyc",
+    ".db", ".sqlite", ".parquet", ".wasm",
+})
+
+# Negative cache for R2 keys that produced nothing useful (missing object,
+# binary content, oversized). Cloud Tasks retries and re-index jobs would
+# otherwise pay the same doomed GET again within seconds.
+NEGATIVE_CACHE_TTL_SEC = int(os.getenv("NEGATIVE_CACHE_TTL_SEC", "300"))
+_negative_keys: Dict[str, float] = {}
+_negative_keys_lock = threading.Lock()
+
+def _negative_cache_hit(r2_object_key: str) -> bool:
+    with _negative_keys_lock:
+        expiry = _negative_keys.get(r2_object_key)
+        if expiry is None:
+            return False
+        if expiry < time.monotonic():
+            del _negative_keys[r2_object_key]
+            return False
+        return True
+
+def _negative_cache_add(r2_object_key: str):
+    now = time.monotonic()
+    with _negative_keys_lock:
+        # Opportunistic prune keeps the dict from growing unbounded.
+        for key in [k for k, exp in _negative_keys.items() if exp < now]:
+            del _negative_keys[key]
+        _negative_keys[r2_object_key] = now + NEGATIVE_CACHE_TTL_SEC
+
 def download_file_from_r2(r2_object_key: str, file_path: str) -> str:
-    """Download file content from R2."""
+    """Download file content from R2, stream-decoding with a hard size cap.
+
+    Decoding incrementally per 1MB chunk avoids holding raw bytes and the
+    decoded str for the whole file at once, and lets the size cap abort the
+    transfer early instead of after a full .read().
+    """
+    if _negative_cache_hit(r2_object_key):
+        logger.info(f"Skipping file {file_path}: R2 key negative-cached from a recent failure")
+        return ""
     try:
         logger.info(f"Attempting to download file {file_path} with R2 key: {r2_object_key}")
         response = r2_client.get_object(Bucket=config.r2_bucket_name, Key=r2_object_key)
-        content = response['Body'].read().decode('utf-8')
-        logger.info(f"Successfully downloaded file {file_path} ({len(content)} bytes)")
+        content_length = response.get('ContentLength')
+        if content_length and content_length > MAX_FILE_BYTES:
+            logger.warning(f"Skipping oversized file {file_path} ({content_length} bytes)")
+            _negative_cache_add(r2_object_key)
+            return ""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parts = []
+        bytes_read = 0
+        for chunk in response['Body'].iter_chunks(chunk_size=1 << 20):
+            bytes_read += len(chunk)
+            if bytes_read > MAX_FILE_BYTES:
+                logger.warning(f"Skipping oversized file {file_path} (exceeded {MAX_FILE_BYTES} bytes mid-stream)")
+                _negative_cache_add(r2_object_key)
+                return ""
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+        content = "".join(parts)
+        logger.info(f"Successfully downloaded file {file_path} ({bytes_read} bytes)")
         return content
     except ClientError as e:
+        # A missing key stays missing until something re-uploads it; retries
+        # inside the TTL skip the round-trip instead of re-fetching the 404.
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            _negative_cache_add(r2_object_key)
         logger.error(f"Failed to download file {file_path} from R2 with key '{r2_object_key}': {e}")
         raise
     except UnicodeDecodeError as e:
         logger.warning(f"Failed to decode file {file_path} as UTF-8, skipping: {e}")
+        _negative_cache_add(r2_object_key)
         return ""
 
 def index_files(workspace_id: str, files: List[WorkerFile]) -> Dict[str, Any]:
-    """Index files in the vector database."""
+    """Index files in the vector database.
+
+    Download, chunking and embedding run as overlapped pipeline stages: as
+    each file's download completes it is chunked, and every full batch of
+    chunks is dispatched to the embedding API while remaining downloads are
+    still in flight. The bounded thread pools provide the backpressure an
+    explicit queue pipeline would otherwise need. The job ends with one
+    upsert, so wall time approaches max(downloads, embeddings) instead of
+    their sum.
+    """
     indexed_count = 0
     skipped_count = 0
     errors = []
-    
+
     # Obtain workspace-specific LanceDB table (creates it if missing)
     table = get_workspace_table(workspace_id)
-    
-    for file_info in files:
-        try:
-            # Download file content using the R2 object key
-            content = download_file_from_r2(file_info.r2_object_key, file_info.file_path)
-            
-            if not content.strip():
-                logger.warning(f"Skipping empty file: {file_info.file_path}")
+
+    ok_files: List[WorkerFile] = []
+    batches: List[List[Any]] = []
+    batch_embeddings: List[Any] = []
+    cached_chunks: List[Any] = []  # (file_info, chunk_idx, chunk, vector) served from the embed cache
+    dup_chunks: List[Any] = []     # duplicates of a chunk already scheduled in this job
+    scheduled_hashes = set()
+    pending: List[Any] = []
+    embed_futures: Dict[Any, int] = {}
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as dl_pool, \
+         ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as embed_pool:
+
+        def submit_pending():
+            nonlocal pending
+            embed_futures[embed_pool.submit(
+                get_embeddings_with_fallback, [chunk for _, _, chunk in pending]
+            )] = len(batches)
+            batches.append(pending)
+            pending = []
+
+        dl_futures = {}
+        for f in files:
+            if os.path.splitext(f.file_path)[1].lower() in BINARY_EXTS:
+                logger.info(f"Skipping binary file before download: {f.file_path}")
                 skipped_count += 1
                 continue
-            
-            # Generate embedding
-            embedding = get_embedding(content)
-            
-            # Delete existing records for this file
+            dl_futures[dl_pool.submit(download_file_from_r2, f.r2_object_key, f.file_path)] = f
+        for future in as_completed(dl_futures):
+            file_info = dl_futures[future]
             try:
-                table.delete(f"workspace_id = '{workspace_id}' AND file_path = '{file_info.file_path}'")
+                content = future.result()
             except Exception as e:
-                logger.warning(f"No existing records to delete for {file_info.file_path}: {e}")
-            
-            # Insert new record
-            data = [{
+                error_msg = f"Failed to index file {file_info.file_path}: {str(e)}"
+                logger.error(error_msg)
+                errors.append(error_msg)
+                continue
+            if not content.strip():
+                logger.warning(f"Skipping empty file: {file_info.file_path}")
+                skipped_count += 1
+                continue
+            ok_files.append(file_info)
+            for i, chunk in enumerate(split_content(file_info.file_path, content)):
+                cached_vector = embed_cache_get(chunk)
+                if cached_vector is not None:
+                    cached_chunks.append((file_info, i, chunk, cached_vector))
+                    continue
+                # Identical content appears a lot within one job (empty
+                # __init__.py, license headers, generated code): embed the
+                # first occurrence only and resolve the rest afterwards.
+                chunk_key = _embed_cache_key(chunk)
+                if chunk_key in scheduled_hashes:
+                    dup_chunks.append((file_info, i, chunk))
+                    continue
+                scheduled_hashes.add(chunk_key)
+                pending.append((file_info, i, chunk))
+                if len(pending) >= EMBED_BATCH_SIZE:
+                    submit_pending()
+        if pending:
+            submit_pending()
+
+        batch_embeddings = [None] * len(batches)
+        for future in as_completed(embed_futures):
+            batch_embeddings[embed_futures[future]] = future.result()
+
+    failed_files = set()
+    if ok_files:
+        # A file with any failed chunk is excluded entirely: partial chunk
+        # coverage would silently degrade retrieval for that file. Successful
+        # vectors enter the shared cache and a per-job map for the duplicate
+        # resolution below.
+        job_vectors: Dict[bytes, List[float]] = {}
+        for batch, embeddings in zip(batches, batch_embeddings):
+            for (file_info, _, chunk), embedding in zip(batch, embeddings):
+                if embedding is None:
+                    if file_info.file_path not in failed_files:
+                        failed_files.add(file_info.file_path)
+                        errors.append(f"Failed to index file {file_info.file_path}: embedding failed")
+                else:
+                    embed_cache_put(chunk, embedding)
+                    job_vectors[_embed_cache_key(chunk)] = embedding
+
+        # Duplicates resolve from the per-job map, never the shared LRU: a
+        # job with more unique chunks than the cache holds would have evicted
+        # early vectors by now and falsely failed their files. A miss here
+        # means the first occurrence's batch genuinely failed.
+        for file_info, i, chunk in dup_chunks:
+            vector = job_vectors.get(_embed_cache_key(chunk))
+            if vector is None:
+                if file_info.file_path not in failed_files:
+                    failed_files.add(file_info.file_path)
+                    errors.append(f"Failed to index file {file_info.file_path}: embedding failed")
+                continue
+            cached_chunks.append((file_info, i, chunk, vector))
+
+        data = []
+        for batch, embeddings in zip(batches, batch_embeddings):
+            for (file_info, i, chunk), embedding in zip(batch, embeddings):
+                if embedding is None or file_info.file_path in failed_files:
+                    continue
+                data.append({
+                    "chunk_id": f"{file_info.file_path}#{i}",
+                    "file_path": file_info.file_path,
+                    "content": chunk,
+                    "workspace_id": workspace_id,
+                    "vector": embedding
+                })
+        for file_info, i, chunk, vector in cached_chunks:
+            if file_info.file_path in failed_files:
+                continue
+            data.append({
+                "chunk_id": f"{file_info.file_path}#{i}",
                 "file_path": file_info.file_path,
-                "content": content,
+                "content": chunk,
                 "workspace_id": workspace_id,
-                "vector": embedding
-            }]
-            table.add(data)
-            
-            indexed_count += 1
-            logger.info(f"Successfully indexed file: {file_info.file_path}")
-            
-        except Exception as e:
-            error_msg = f"Failed to index file {file_info.file_path}: {str(e)}"
-            logger.error(error_msg)
-            errors.append(error_msg)
-    
+                "vector": vector
+            })
+
+        for file_info in ok_files:
+            if file_info.file_path not in failed_files:
+                indexed_count += 1
+                logger.info(f"Successfully indexed file: {file_info.file_path}")
+
+        if data:
+            # Final stage: single merge_insert upsert instead of delete-then-add.
+            # One write pass, no tombstone-then-append fragmentation. The
+            # by-source-delete clause is scoped to the files that embedded
+            # successfully so their stale chunks (from longer old versions)
+            # are dropped without touching the rest of the workspace.
+            reindexed_paths = ", ".join(
+                quote_predicate_value(file_info.file_path) for file_info in ok_files
+                if file_info.file_path not in failed_files
+            )
+            (
+                table.merge_insert(["workspace_id", "chunk_id"])
+                .when_matched_update_all()
+                .when_not_matched_insert_all()
+                .when_not_matched_by_source_delete(f"file_path IN ({reindexed_paths})")
+                .execute(data)
+            )
+            maybe_create_vector_index(table, workspace_id)
+
     return {
         "indexed_count": indexed_count,
         "skipped_count": skipped_count,
@@ -236,7 +601,9 @@ async def handle_indexing_task(request: RagIndexingRequest):
     logger.info(f"Processing RAG indexing task for job {request.job_id}, workspace {request.workspace_id}")
     
     try:
-        result = index_files(request.workspace_id, request.files)
+        # index_files is synchronous (boto3 + LanceDB); run it off the event
+        # loop so health checks and other requests aren't stalled behind a job.
+        result = await run_in_threadpool(index_files, request.workspace_id, request.files)
         
         logger.info(f"RAG indexing completed for job {request.job_id}: {result}")
         
@@ -1,6 +1,23 @@
-# This module will hold shared resources that are initialized at startup.
+# This module holds shared resources that the agent tools need.
 # It allows our tools to access things like the database connection
 # without creating complex dependencies or circular imports.
+#
+# Process-wide handles (set once at startup) stay plain module globals.
+# Request-scoped state lives in ContextVars: with concurrent requests a
+# shared global could be overwritten by request A between request B's
+# assignment and B's graph invoke, silently searching the wrong
+# workspace. ContextVars propagate through asyncio.to_thread and
+# LangChain's executors, so the graph sees its own request's values.
+from contextvars import ContextVar
 
-db_connection = None
-embedding_model = None 
\ No newline at end of file
+embedding_model = None
+
+# LanceDB handles for the requesting workspace; set by the request handler.
+db_connection_var: ContextVar = ContextVar("db_connection", default=None)
+table_var: ContextVar = ContextVar("table", default=None)
+# Workspace the current request is scoped to, so the codebase search tool
+# can prefilter queries to the right tenant.
+workspace_id_var: ContextVar = ContextVar("workspace_id", default=None)
+# Optional callable(partial_text) the request handler installs so the
+# summarizer can surface partial output while tokens are still streaming.
+report_progress_var: ContextVar = ContextVar("report_progress", default=None)
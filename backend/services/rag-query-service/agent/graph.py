@@ -1,11 +1,18 @@
+import operator
+import os
+import threading
+import time
+from collections import OrderedDict
+
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel, Field
 from langgraph.graph import StateGraph, END
-from typing import TypedDict, List, Optional
+from typing import Annotated, TypedDict, List, Optional
 
 from config import settings
-from agent.tools import web_search_tool, codebase_search_tool
+from agent.tools import web_search_cached, codebase_search_tool
+from agent import dependencies
 from agent import prompts
 
 # --- 1. State Definition ---
@@ -13,14 +20,21 @@ class AgentState(TypedDict):
     """
     Represents the state of our agent in the LangGraph.
     """
-    user_query: str                  
-    raw_code_snippets: List[str]     
-    raw_web_results: List[str]       
+    user_query: str
+    # operator.add reducers let the fanned-out retrieval branches append their
+    # results concurrently instead of racing to overwrite the whole list.
+    raw_code_snippets: Annotated[List[str], operator.add]
+    raw_web_results: Annotated[List[str], operator.add]
     summarized_context: Optional[str]
-    next_action: Optional[str]       
+    next_action: Optional[str]
+    hypothetical_doc: Optional[str]
 
 # --- LLM and Tools Initialization ---
+# Pro for synthesis (summarizer); Flash for the planner, which is a routing
+# decision plus a short code fragment - Flash handles it at a fraction of the
+# latency, and the planner sits on every request's critical path.
 llm = ChatGoogleGenerativeAI(model=settings.GEMINI_MODEL_NAME, temperature=0)
+flash_llm = ChatGoogleGenerativeAI(model=settings.GEMINI_FLASH_MODEL_NAME, temperature=0)
 
 # --- 2. Node Definitions ---
 
@@ -28,30 +42,66 @@ llm = ChatGoogleGenerativeAI(model=settings.GEMINI_MODEL_NAME, temperature=0)
 class RetrievalStrategy(BaseModel):
     """The retrieval strategy to use for the user's query."""
     next_action: str = Field(description="The next action to take. One of: 'search_code_and_web', 'search_code_only', 'search_web_only', 'no_retrieval'")
+    hypothetical_document: str = Field(
+        default="",
+        description="A short hypothetical code fragment capturing the query's intent, used for vector search. Empty unless the action includes a codebase search."
+    )
+
+# Chains are assembled once at import: prompt construction and the structured-
+# output schema conversion are pure CPU overhead to repeat per request.
+planner_chain = ChatPromptTemplate.from_messages([
+    ("system", prompts.PLANNER_PROMPT),
+    ("human", "User Query: {user_query}"),
+]) | flash_llm.with_structured_output(RetrievalStrategy)
+
+# Planner decision cache. The planner burns a full LLM round-trip to pick one
+# of four branches, queries repeat heavily ("explain the auth code"), and at
+# temperature=0 the decision is deterministic for a given query - so an
+# exact-match cache on the normalized query is safe. TTL'd in case the
+# planner prompt's behavior is tuned between deploys.
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "512"))
+PLAN_CACHE_TTL_SEC = int(os.getenv("PLAN_CACHE_TTL_SEC", str(24 * 3600)))
+_plan_cache: OrderedDict = OrderedDict()
+_plan_cache_lock = threading.Lock()
 
 def plan_retrieval_strategy(state: AgentState) -> dict:
-    """Uses an LLM to determine the most relevant search type(s) based on the query."""
+    """Uses an LLM to pick the search strategy and, when the codebase will be
+    searched, generate the HyDE document in the same round-trip.
+
+    Folding HyDE generation into the planner's structured output removes one
+    of the two serial LLM calls that previously gated every codebase search.
+    """
     print("---PLANNING RETRIEVAL STRATEGY---")
-    
-    structured_llm = llm.with_structured_output(RetrievalStrategy)
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", prompts.PLANNER_PROMPT),
-        ("human", "User Query: {user_query}"),
-    ])
-    
-    chain = prompt | structured_llm
-    result = chain.invoke({"user_query": state['user_query']})
-    
+
+    cache_key = " ".join(state['user_query'].lower().split())
+    now = time.monotonic()
+    with _plan_cache_lock:
+        cached = _plan_cache.get(cache_key)
+        if cached is not None and cached[2] > now:
+            _plan_cache.move_to_end(cache_key)
+            print(f"Chosen strategy (cached): {cached[0]}")
+            return {"next_action": cached[0], "hypothetical_doc": cached[1]}
+
+    result = planner_chain.invoke({"user_query": state['user_query']})
+    hypothetical_doc = result.hypothetical_document or None
+
+    with _plan_cache_lock:
+        _plan_cache[cache_key] = (result.next_action, hypothetical_doc, now + PLAN_CACHE_TTL_SEC)
+        _plan_cache.move_to_end(cache_key)
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
     print(f"Chosen strategy: {result.next_action}")
-    return {"next_action": result.next_action}
+    return {"next_action": result.next_action, "hypothetical_doc": hypothetical_doc}
 
 # Node 2: Retrieve Codebase Context
 def retrieve_codebase_context(state: AgentState) -> dict:
     """Calls the Codebase Search Tool."""
     print("---RETRIEVING CODEBASE CONTEXT---")
-    query = state['user_query']
-    snippets = codebase_search_tool.invoke(query)
+    snippets = codebase_search_tool.invoke({
+        "query": state['user_query'],
+        "hypothetical_doc": state.get('hypothetical_doc'),
+    })
     return {"raw_code_snippets": [snippets]}
 
 # Node 3: Retrieve Web Context
@@ -59,28 +109,48 @@ def retrieve_web_context(state: AgentState) -> dict:
     """Calls the Web Search Tool."""
     print("---RETRIEVING WEB CONTEXT---")
     query = state['user_query']
-    web_results = web_search_tool.invoke(query)
+    web_results = web_search_cached(query)
     return {"raw_web_results": [web_results]}
 
 # Node 4: Summarize Context
+summarizer_chain = ChatPromptTemplate.from_messages([
+    ("system", prompts.SUMMARIZER_PROMPT),
+    ("human", "User Query: {user_query}\n\nCode Snippets:\n{code_snippets}\n\nWeb Results:\n{web_results}"),
+]) | llm
+
+# Flush partial summaries at most this often; per-token writes would burn
+# Firestore quota for no perceptible UX gain.
+SUMMARY_FLUSH_INTERVAL_SEC = float(os.getenv("SUMMARY_FLUSH_INTERVAL_SEC", "0.2"))
+
 def summarize_context(state: AgentState) -> dict:
-    """Summarizes all retrieved information into a focused, concise context."""
+    """Summarizes all retrieved information into a focused, concise context.
+
+    The summary is the slowest LLM call in the pipeline, so it streams:
+    tokens accumulate as they arrive and, when the request handler installed
+    a progress callback, partial text is flushed to it on a throttle so the
+    client can render the answer while it is still being generated.
+    """
     print("---SUMMARIZING CONTEXT---")
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", prompts.SUMMARIZER_PROMPT),
-        ("human", "User Query: {user_query}\n\nCode Snippets:\n{code_snippets}\n\nWeb Results:\n{web_results}"),
-    ])
-    
-    chain = prompt | llm
-    
-    summary = chain.invoke({
+    report_progress = dependencies.report_progress_var.get()
+    parts: List[str] = []
+    last_flush = time.monotonic()
+    for chunk in summarizer_chain.stream({
         "user_query": state['user_query'],
         "code_snippets": "\n---\n".join(state['raw_code_snippets']),
         "web_results": "\n---\n".join(state['raw_web_results']),
-    })
-    
-    return {"summarized_context": summary.content}
+    }):
+        parts.append(chunk.content)
+        now = time.monotonic()
+        if report_progress and now - last_flush >= SUMMARY_FLUSH_INTERVAL_SEC:
+            last_flush = now
+            try:
+                report_progress("".join(parts))
+            except Exception as e:
+                print(f"  - Progress flush failed (continuing): {e}")
+                report_progress = None
+
+    return {"summarized_context": "".join(parts)}
 
 
 # --- 3. Graph Flow Definition ---
@@ -95,12 +165,15 @@ workflow.add_node("summarize_context", summarize_context)
 # Set the entry point
 workflow.set_entry_point("plan_retrieval")
 
-# Define conditional edges from the planning node
-def route_after_planning(state: AgentState) -> str:
-    """Route to the appropriate next step based on the planning decision."""
+# Define conditional edges from the planning node. Returning a list fans out:
+# LangGraph schedules both retrieval nodes in the same superstep and runs them
+# concurrently, so "search_code_and_web" costs max(code, web) latency instead
+# of the sum the old code -> web chain paid.
+def route_after_planning(state: AgentState):
+    """Route to the appropriate next step(s) based on the planning decision."""
     action = state['next_action']
     if action == "search_code_and_web":
-        return "retrieve_codebase"  # We'll handle the web search after codebase
+        return ["retrieve_codebase", "retrieve_web"]
     elif action == "search_code_only":
         return "retrieve_codebase"
     elif action == "search_web_only":
@@ -118,30 +191,20 @@ workflow.add_conditional_edges(
     }
 )
 
-# For the "search_code_and_web" case, we need to route from codebase to web search
-def route_after_codebase(state: AgentState) -> str:
-    """Route after codebase search - check if we also need web search."""
-    if state['next_action'] == "search_code_and_web":
-        return "retrieve_web"
-    else:
-        return "summarize_context"
-
-workflow.add_conditional_edges(
-    "retrieve_codebase",
-    route_after_codebase,
-    {
-        "retrieve_web": "retrieve_web",
-        "summarize_context": "summarize_context",
-    }
-)
-
-# After web retrieval, go to summarization
+# Both retrieval branches join at summarization; with a fan-out it runs once,
+# after every scheduled branch has finished.
+workflow.add_edge("retrieve_codebase", "summarize_context")
 workflow.add_edge("retrieve_web", "summarize_context")
 
 # The final node in this RAG segment
 workflow.add_edge("summarize_context", END)
 
-# Compile the graph
+# Compile the graph. No checkpointer: retries arrive as fresh invocations
+# with full input, which LangGraph treats as a new run from START rather
+# than a resume (resume requires invoking with None input), and an
+# in-process saver keyed by ever-unique job ids would retain every job's
+# snippets and summaries for the process lifetime. Retry cost is absorbed
+# by the plan/embedding/rerank/answer caches instead.
 agent_graph = workflow.compile()
 
 # Example of how to run it:
@@ -19,6 +19,8 @@ Choose **one** of the following actions and output it as `next_action`:
 • `no_retrieval` – the question is trivial (small-talk) or already answerable from prior context without new searches.
 
 Think step-by-step.  Prefer the codebase when the user explicitly references filenames, functions, classes, repository structure, or says "in our code".  Prefer the web when the user references general tech ("What's GPT-4?", "How to center a div?").  If both are present, choose `search_code_and_web`.
+
+Additionally, whenever your chosen action includes searching the codebase, output as `hypothetical_document` a SHORT (max 40 lines) self-contained code fragment **only** (no prose, no comments, no markdown fences) that would likely satisfy the user's request.  This synthetic snippet will be embedded and used for vector search inside the user's private repository, so include meaningful identifiers, class names, and function calls that capture the essence of the query.  For other actions, leave `hypothetical_document` empty.
 """
 
 SUMMARIZER_PROMPT = """You are an expert technical writer.
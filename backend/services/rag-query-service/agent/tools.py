@@ -1,3 +1,11 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_core.tools import tool
 from langchain_core.prompts import ChatPromptTemplate
@@ -14,96 +22,267 @@ from agent import prompts
 # This is a standard tool for performing web searches.
 web_search_tool = DuckDuckGoSearchRun()
 
+# DuckDuckGo is a scrape - a full HTTP round-trip plus HTML parsing per call.
+# Web results for a query barely change minute to minute, so a short-TTL
+# cache on the normalized query absorbs repeats (and the fan-out retries
+# Cloud Tasks can produce) without serving stale pages for long.
+WEB_CACHE_SIZE = int(os.getenv("WEB_CACHE_SIZE", "256"))
+WEB_CACHE_TTL_SEC = int(os.getenv("WEB_CACHE_TTL_SEC", "300"))
+_web_cache: OrderedDict = OrderedDict()
+_web_cache_lock = threading.Lock()
+
+def web_search_cached(query: str) -> str:
+    """web_search_tool.invoke with a TTL'd LRU keyed by normalized query."""
+    key = " ".join(query.lower().split())
+    now = time.monotonic()
+    with _web_cache_lock:
+        entry = _web_cache.get(key)
+        if entry is not None and entry[1] > now:
+            _web_cache.move_to_end(key)
+            return entry[0]
+    results = web_search_tool.invoke(query)
+    with _web_cache_lock:
+        _web_cache[key] = (results, now + WEB_CACHE_TTL_SEC)
+        _web_cache.move_to_end(key)
+        while len(_web_cache) > WEB_CACHE_SIZE:
+            _web_cache.popitem(last=False)
+    return results
+
 # --- Hypothetical Document Generation (HyDE) ---
 hyde_prompt_template = ChatPromptTemplate.from_messages([
     ("system", prompts.HYDE_PROMPT),
     ("human", "User Query: {query}"),
 ])
 
-# Use the same LLM as the main agent for consistency
-hyde_llm = ChatGoogleGenerativeAI(model=settings.GEMINI_MODEL_NAME, temperature=0)
+# Flash is plenty for a short synthetic snippet, and this fallback sits on
+# the critical path when the planner didn't supply a HyDE document.
+hyde_llm = ChatGoogleGenerativeAI(model=settings.GEMINI_FLASH_MODEL_NAME, temperature=0)
 hyde_chain = hyde_prompt_template | hyde_llm
 
+# --- Hybrid search fusion ---
+# Standard RRF damping constant (k=60 from the original paper); caps how much
+# a #1 rank can dominate. RRF_CANDIDATES bounds what we send to Cohere.
+RRF_K = 60
+RRF_CANDIDATES = 20
+
+# Both halves of the hybrid search are independent R2 round-trips; a small
+# shared pool lets the vector search run while the keyword search executes on
+# the calling thread.
+_search_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-search")
+
 # --- Reranker Initialization ---
 # The user needs to provide a Cohere API key in the environment variables.
 reranker = CohereRerank(
-    cohere_api_key=settings.COHERE_API_KEY, 
+    cohere_api_key=settings.COHERE_API_KEY,
     model="rerank-english-v3.0",  # Cohere's latest rerank model
     top_n=10
 )
 
+# Cohere scores each (query, document) pair with a cross-encoder; payload size
+# directly drives latency and cost, and relevance for a code chunk is decided
+# well before 3200 chars (~800 tokens).
+RERANK_MAX_CHARS = int(os.getenv("RERANK_MAX_CHARS", "3200"))
+
+# Rerank results are deterministic for a given (query, candidate set), and
+# with the search caches upstream repeat queries produce identical candidate
+# sets - so an exact-match LRU saves the whole Cohere round-trip on repeats.
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "256"))
+_rerank_cache: OrderedDict = OrderedDict()
+_rerank_cache_lock = threading.Lock()
+
+
+# --- Embedding cache ---
+# embed_query is a remote Google API call; identical queries produce identical
+# HyDE docs at temperature=0, so repeats are common. An embedding for a given
+# text never changes, so entries need no TTL - LRU eviction bounds memory.
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2000"))
+_embed_cache: OrderedDict = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+def embed_query_cached(text: str):
+    """embedding_model.embed_query with a content-hash-keyed LRU in front."""
+    key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    with _embed_cache_lock:
+        vector = _embed_cache.get(key)
+        if vector is not None:
+            _embed_cache.move_to_end(key)
+            return vector
+    vector = dependencies.embedding_model.embed_query(text)
+    with _embed_cache_lock:
+        _embed_cache[key] = vector
+        _embed_cache.move_to_end(key)
+        while len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+    return vector
+
+# Fallback HyDE outputs are deterministic per query (temperature=0), so they
+# get the same treatment.
+HYDE_CACHE_SIZE = int(os.getenv("HYDE_CACHE_SIZE", "512"))
+_hyde_cache: OrderedDict = OrderedDict()
+_hyde_cache_lock = threading.Lock()
+
+def _hyde_doc_cached(query: str) -> str:
+    key = " ".join(query.lower().split())
+    with _hyde_cache_lock:
+        doc = _hyde_cache.get(key)
+        if doc is not None:
+            _hyde_cache.move_to_end(key)
+            return doc
+    doc = hyde_chain.invoke({"query": query}).content
+    with _hyde_cache_lock:
+        _hyde_cache[key] = doc
+        _hyde_cache.move_to_end(key)
+        while len(_hyde_cache) > HYDE_CACHE_SIZE:
+            _hyde_cache.popitem(last=False)
+    return doc
+
 
 # --- Codebase Search Tool ---
 @tool
-def codebase_search_tool(query: str) -> str:
+def codebase_search_tool(query: str, hypothetical_doc: Optional[str] = None) -> str:
     """
     Searches the project's codebase for relevant snippets using a sophisticated
     hybrid search and reranking strategy.
 
     This multi-step process includes:
-    1.  **HyDE (Hypothetical Document Embeddings):** Generates a hypothetical code snippet to better capture the user's intent for vector search.
+    1.  **HyDE (Hypothetical Document Embeddings):** Uses the hypothetical code snippet produced by the planner (generating one here only as a fallback) to better capture the user's intent for vector search.
     2.  **Hybrid Search:** Performs both a keyword-based full-text search (BM25-like) and a dense vector search using the HyDE embedding.
     3.  **Reranking:** Uses a Cohere model to rerank the combined results for maximum relevance.
     """
     print(f"--- INFO: Advanced codebase search started for query: '{query}' ---")
 
-    if not dependencies.db_connection or not dependencies.embedding_model:
+    db_connection = dependencies.db_connection_var.get()
+    if not db_connection or not dependencies.embedding_model:
         return "Error: Codebase search tool is not initialized. The database connection or embedding model is missing."
 
-    try:
-        table = dependencies.db_connection.open_table(settings.LANCEDB_TABLE_NAME)
-    except FileNotFoundError:
-        return f"Error: The LanceDB table '{settings.LANCEDB_TABLE_NAME}' was not found. The database may be empty or the index name is incorrect."
+    # The request handler caches and shares the table handle; opening here is
+    # only a fallback (each open_table costs R2 manifest round-trips).
+    table = dependencies.table_var.get()
+    if table is None:
+        try:
+            table = db_connection.open_table(settings.LANCEDB_TABLE_NAME)
+        except FileNotFoundError:
+            return f"Error: The LanceDB table '{settings.LANCEDB_TABLE_NAME}' was not found. The database may be empty or the index name is incorrect."
 
-    # 1. HyDE: Generate a hypothetical document
-    print("  - Step 1: Generating hypothetical document (HyDE)...")
-    hypothetical_doc = hyde_chain.invoke({"query": query}).content
-    print(f"  - HyDE document generated:\n---\n{hypothetical_doc}\n---")
-    query_vector = dependencies.embedding_model.embed_query(hypothetical_doc)
+    # 1. HyDE: normally supplied by the planner (one LLM round-trip covers
+    # both decisions); generate one here only if it didn't arrive.
+    if not hypothetical_doc:
+        print("  - Step 1: Generating hypothetical document (HyDE fallback)...")
+        hypothetical_doc = _hyde_doc_cached(query)
+    print(f"  - HyDE document:\n---\n{hypothetical_doc}\n---")
+    query_vector = embed_query_cached(hypothetical_doc)
 
     # 2. Hybrid Search
     print("  - Step 2: Performing hybrid search (vector + keyword)...")
-    # Vector search with the HyDE embedding
-    vector_results = table.search(query_vector).limit(10).to_list()
+    # Prefilter on the requesting workspace: the scalar index on workspace_id
+    # (built by the indexing service) restricts the IVF probe set up front
+    # instead of filtering rows after the scan, and it guarantees no
+    # cross-tenant rows can surface even if a table is ever shared.
+    workspace_filter = None
+    workspace_id = dependencies.workspace_id_var.get()
+    if workspace_id:
+        workspace_filter = "workspace_id = '{}'".format(str(workspace_id).replace("'", "''"))
+
+    # Vector search with the HyDE embedding. nprobes/refine_factor tune the
+    # IVF_PQ index the indexing service builds on large tables: probe 20
+    # partitions for recall, then re-rank 10x candidates with exact distances
+    # to undo PQ quantization error. Both are no-ops while a table is still
+    # small enough to be served by a flat scan.
+    def run_vector_search():
+        vector_search = table.search(query_vector).nprobes(20).refine_factor(10).limit(10)
+        if workspace_filter:
+            vector_search = vector_search.where(workspace_filter, prefilter=True)
+        return vector_search.to_list()
+
     # Keyword search (BM25/FTS) with the original query.  If the FTS index is
     # still being built (or missing) LanceDB raises an error – we catch it and
     # fall back to vector-only results instead of propagating the exception to
     # the user.
-    try:
-        keyword_results = table.search(query).limit(10).to_list()
-    except Exception as e:
-        print(f"  - Keyword search skipped (FTS index not ready?): {e}")
-        keyword_results = []
+    def run_keyword_search():
+        try:
+            keyword_search = table.search(query).limit(10)
+            if workspace_filter:
+                keyword_search = keyword_search.where(workspace_filter)
+            return keyword_search.to_list()
+        except Exception as e:
+            print(f"  - Keyword search skipped (FTS index not ready?): {e}")
+            return []
+
+    # Overlap the two searches: vector on a pool thread, keyword here, then
+    # join - the hybrid step costs max(vector, keyword) instead of their sum.
+    vector_future = _search_pool.submit(run_vector_search)
+    keyword_results = run_keyword_search()
+    vector_results = vector_future.result()
 
-    # Combine and deduplicate results (use 'content' column which stores code text)
-    combined_results = {res['content']: res for res in vector_results + keyword_results}.values()
-    print(f"  - Found {len(list(combined_results))} unique snippets from hybrid search.")
+    # Fuse the two ranked lists with Reciprocal Rank Fusion: each snippet
+    # scores sum(1 / (k + rank)) over the lists it appears in, so results both
+    # searches agree on bubble up without having to compare the incomparable
+    # raw scores (cosine distance vs BM25). Dedupe on 'content' (the code
+    # text), keeping the accumulated score.
+    fused: dict = {}
+    for results in (vector_results, keyword_results):
+        for rank, res in enumerate(results):
+            entry = fused.get(res['content'])
+            if entry is None:
+                entry = fused[res['content']] = [0.0, res]
+            entry[0] += 1.0 / (RRF_K + rank + 1)
+    combined_results = [
+        res for _, res in sorted(fused.values(), key=lambda entry: entry[0], reverse=True)
+    ][:RRF_CANDIDATES]
+    print(f"  - Fused {len(combined_results)} unique snippets from hybrid search.")
 
     if not combined_results:
         return "No relevant code snippets found in the codebase for your query."
 
     # 3. Reranking
     print("  - Step 3: Reranking results with Cohere...")
-    # LangChain's CohereRerank expects a list of Documents
+    # LangChain's CohereRerank expects a list of Documents. Truncate each
+    # candidate to RERANK_MAX_CHARS - the cross-encoder's verdict is made well
+    # within that window, and payload size drives Cohere latency and cost.
     documents_to_rerank = [
-        Document(page_content=res['content'], metadata={"file_path": res.get('file_path', 'Unknown file')})
+        Document(
+            page_content=res['content'][:RERANK_MAX_CHARS],
+            metadata={"file_path": res.get('file_path', 'Unknown file')},
+        )
         for res in combined_results
     ]
-    
-    reranked_docs = reranker.compress_documents(documents=documents_to_rerank, query=query)
-    print(f"  - Reranked down to {len(reranked_docs)} snippets.")
-    
-    if not reranked_docs:
+
+    # Key the cache on the query plus the exact (ordered) candidate payloads.
+    cache_hasher = hashlib.blake2b(query.encode(), digest_size=16)
+    for doc in documents_to_rerank:
+        cache_hasher.update(b"\x00")
+        cache_hasher.update(doc.page_content.encode())
+    rerank_key = cache_hasher.digest()
+
+    with _rerank_cache_lock:
+        reranked = _rerank_cache.get(rerank_key)
+        if reranked is not None:
+            _rerank_cache.move_to_end(rerank_key)
+
+    if reranked is None:
+        reranked_docs = reranker.compress_documents(documents=documents_to_rerank, query=query)
+        reranked = [
+            (doc.page_content, doc.metadata.get('file_path', 'Unknown file'))
+            for doc in reranked_docs
+        ]
+        with _rerank_cache_lock:
+            _rerank_cache[rerank_key] = reranked
+            _rerank_cache.move_to_end(rerank_key)
+            while len(_rerank_cache) > RERANK_CACHE_SIZE:
+                _rerank_cache.popitem(last=False)
+    else:
+        print("  - Rerank cache hit; skipping Cohere call.")
+    print(f"  - Reranked down to {len(reranked)} snippets.")
+
+    if not reranked:
         return "No relevant code snippets found after reranking."
 
     # 4. Format final results
     formatted_results = []
     # top_n is handled by the reranker initialization
-    for i, doc in enumerate(reranked_docs):
-        file_path = doc.metadata.get('file_path', 'Unknown file')
-        content = doc.page_content
+    for i, (content, file_path) in enumerate(reranked):
         formatted_results.append(f"Snippet {i+1} from '{file_path}':\n```\n{content}\n```")
-        
+
     final_output = "\n\n---\n\n".join(formatted_results)
-    print(f"--- INFO: Advanced codebase search finished. Returning {len(reranked_docs)} snippets. ---")
+    print(f"--- INFO: Advanced codebase search finished. Returning {len(reranked)} snippets. ---")
     return final_output
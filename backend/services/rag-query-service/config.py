@@ -27,6 +27,9 @@ class Settings(BaseSettings):
 
     # Gemini Model Configuration
     GEMINI_MODEL_NAME: str = "gemini-1.5-pro"
+    # Lighter model for classification-style calls (planner routing, HyDE
+    # fallback) where Pro-level quality isn't needed but latency is.
+    GEMINI_FLASH_MODEL_NAME: str = "gemini-1.5-flash"
     EMBEDDING_MODEL_NAME: str = "models/text-embedding-004"
     EMBEDDING_MODEL_DIM: int = 768
 
@@ -1,5 +1,10 @@
+import asyncio
+import hashlib
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 import uvicorn
 from datetime import timedelta
@@ -7,35 +12,45 @@ from datetime import timedelta
 import google.generativeai as genai
 import lancedb
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_core.documents import Document
 from agent.graph import agent_graph
+from agent.tools import reranker
 from agent import dependencies
 from config import settings
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import BackgroundTasks, FastAPI, Request, HTTPException
 from pydantic import BaseModel
 from google.cloud import firestore as google_firestore
 
 # Environment Variables
 COLLECTION_ID_JOBS = os.getenv("COLLECTION_ID_JOBS", "jobs")
 
-# Global Firestore client
-firestore_client: google_firestore.Client | None = None
+# Global Firestore client. The async client keeps status writes off the event
+# loop - the sync client would block every other in-flight request for the
+# duration of each Firestore round-trip.
+firestore_client: google_firestore.AsyncClient | None = None
+# Jobs collection reference, built once - saves a dict lookup + object
+# construction on every status write.
+jobs_collection = None
 
-def get_firestore_client() -> google_firestore.Client | None:
+def get_firestore_client() -> google_firestore.AsyncClient | None:
     return firestore_client
 
 def init_firestore_client():
-    global firestore_client
-    
+    global firestore_client, jobs_collection
+
     if settings.GCP_PROJECT_ID:
         try:
-            firestore_client = google_firestore.Client(project=settings.GCP_PROJECT_ID)
+            firestore_client = google_firestore.AsyncClient(project=settings.GCP_PROJECT_ID)
+            jobs_collection = firestore_client.collection(COLLECTION_ID_JOBS)
             logging.info("Firestore client initialized.")
         except Exception as e:
             logging.error(f"Failed to initialize Firestore client: {e}")
             firestore_client = None
+            jobs_collection = None
     else:
         logging.error("GCP_PROJECT_ID environment variable not set. Firestore client NOT initialized.")
         firestore_client = None
+        jobs_collection = None
 
 class CloudTaskQueryPayload(BaseModel):
     job_id: str
@@ -43,28 +58,52 @@ class CloudTaskQueryPayload(BaseModel):
     workspace_id: str
     query: str
 
+# Answer cache for repeated queries. A hit skips the whole pipeline - planner
+# and summarizer LLM calls, HyDE, both LanceDB searches and the Cohere rerank.
+# Keyed by (workspace_id, normalized query); the short TTL doubles as
+# invalidation, since a workspace's index may be rebuilt at any time.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL_SEC = int(os.getenv("QUERY_CACHE_TTL_SEC", "600"))
+_query_cache: OrderedDict = OrderedDict()
+_query_cache_lock = threading.Lock()
+_query_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def _query_cache_key(workspace_id: str, query: str) -> bytes:
+    digest = hashlib.sha256()
+    digest.update(workspace_id.encode())
+    digest.update(b"\x00")
+    digest.update(" ".join(query.lower().split()).encode())
+    return digest.digest()
+
+def query_cache_get(workspace_id: str, query: str) -> str | None:
+    key = _query_cache_key(workspace_id, query)
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            _query_cache_stats["misses"] += 1
+            return None
+        _query_cache.move_to_end(key)
+        _query_cache_stats["hits"] += 1
+        return entry[0]
+
+def query_cache_put(workspace_id: str, query: str, response_text: str):
+    key = _query_cache_key(workspace_id, query)
+    with _query_cache_lock:
+        _query_cache[key] = (response_text, time.monotonic() + QUERY_CACHE_TTL_SEC)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+            _query_cache_stats["evictions"] += 1
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Lifespan context manager to handle startup and shutdown events.
     """
     # Startup: Initialize Firestore, LanceDB, and Gemini
+    # (Required env vars are validated by pydantic when Settings() is built
+    # at import - a missing one fails the process before lifespan runs.)
     try:
-        # Validate required environment variables
-        required_vars = {
-            "GCP_PROJECT_ID": settings.GCP_PROJECT_ID,
-            "GOOGLE_API_KEY": settings.GOOGLE_API_KEY,
-            "COHERE_API_KEY": settings.COHERE_API_KEY,
-            "R2_ACCESS_KEY_ID": settings.R2_ACCESS_KEY_ID,
-            "R2_SECRET_ACCESS_KEY": settings.R2_SECRET_ACCESS_KEY,
-            "R2_ACCOUNT_ID": settings.R2_ACCOUNT_ID,
-            "R2_BUCKET_NAME": settings.R2_BUCKET_NAME,
-        }
-        
-        missing_vars = [var for var, value in required_vars.items() if not value]
-        if missing_vars:
-            raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
-        
         # Initialize Firestore client
         init_firestore_client()
         
@@ -72,14 +111,8 @@ async def lifespan(app: FastAPI):
         genai.configure(api_key=settings.GOOGLE_API_KEY)
         logging.info("Google Generative AI configured successfully")
         
-        # Set environment variables for LanceDB S3-compatible storage
-        os.environ["AWS_ACCESS_KEY_ID"] = settings.R2_ACCESS_KEY_ID
-        os.environ["AWS_SECRET_ACCESS_KEY"] = settings.R2_SECRET_ACCESS_KEY
-        os.environ["AWS_ENDPOINT"] = settings.R2_ENDPOINT_URL
-        os.environ["AWS_DEFAULT_REGION"] = "auto"
-        
         # Initialize LanceDB connection
-        db_connection = lancedb.connect(settings.LANCEDB_URI)
+        db_connection = lancedb.connect(settings.LANCEDB_URI, storage_options=_LANCEDB_STORAGE_OPTIONS)
         
         # ------------------------------------------------------------------
         # Guarantee Full-Text Search (FTS) support
@@ -98,7 +131,9 @@ async def lifespan(app: FastAPI):
             table = db_connection.open_table(settings.LANCEDB_TABLE_NAME)
 
             # Create/verify the index (native FTS) on the `content` column.
-            table.create_fts_index("content")  # no-op if exists
+            # Positions aren't needed for BM25 ranking (no phrase queries),
+            # and skipping them keeps the index smaller and faster to read.
+            table.create_fts_index("content", use_tantivy=False, with_position=False)  # no-op if exists
 
             # Wait (up to 2 minutes) for the index build to finish so that
             # early queries don't fail.  If the method isn't available (older
@@ -113,6 +148,17 @@ async def lifespan(app: FastAPI):
             except Exception as e:
                 logging.warning(f"FTS index build not confirmed within timeout: {e}")
 
+            # Prime LanceDB's caches with throwaway searches so the first
+            # real query doesn't pay the cold manifest + index page fetches
+            # from R2: a zero-vector search pulls the IVF centroids, a text
+            # search pulls the FTS posting-list reader.
+            try:
+                table.search([0.0] * settings.EMBEDDING_MODEL_DIM).limit(1).to_list()
+                table.search("warmup").limit(1).to_list()
+                logging.info("LanceDB warmup searches completed.")
+            except Exception as e:
+                logging.warning(f"LanceDB warmup search failed (continuing): {e}")
+
         except FileNotFoundError:
             logging.error(f"LanceDB table '{settings.LANCEDB_TABLE_NAME}' not found – keyword search will be unavailable until the indexing service creates the table.")
         except Exception as e:
@@ -124,8 +170,8 @@ async def lifespan(app: FastAPI):
             google_api_key=settings.GOOGLE_API_KEY
         )
         
-        # Set up dependencies for the agent tools
-        dependencies.db_connection = db_connection
+        # Set up process-wide dependencies for the agent tools. The LanceDB
+        # handles are request-scoped ContextVars set by the handler.
         dependencies.embedding_model = embedding_model
         
         logging.info(f"Successfully connected to LanceDB. Available tables: {db_connection.table_names()}")
@@ -134,6 +180,16 @@ async def lifespan(app: FastAPI):
         model = genai.GenerativeModel(settings.GEMINI_MODEL_NAME)
         test_response = model.generate_content("Hello, this is a test.")
         logging.info(f"Gemini test successful: {test_response.text[:50]}...")
+
+        # Warm the other remote clients the same way: the first call on each
+        # pays DNS + TLS + channel setup that would otherwise land on the
+        # first real request after deploy.
+        try:
+            embedding_model.embed_query("warmup")
+            reranker.compress_documents([Document(page_content="warmup")], query="warmup")
+            logging.info("Embedding and rerank clients warmed up.")
+        except Exception as e:
+            logging.warning(f"Client warmup failed (continuing): {e}")
         
         # Set agent graph
         app.state.agent_graph = agent_graph
@@ -156,9 +212,103 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-@google_firestore.transactional
-def _update_job_in_transaction(transaction: google_firestore.Transaction, job_ref: google_firestore.DocumentReference, update_data: dict):
-    transaction.update(job_ref, update_data)
+# R2 credentials passed inline to each connect. Mutating process-wide AWS_*
+# env vars worked, but it leaked the creds to everything else in the process
+# and pins the whole service to a single credential set.
+_LANCEDB_STORAGE_OPTIONS = {
+    "access_key_id": settings.R2_ACCESS_KEY_ID,
+    "secret_access_key": settings.R2_SECRET_ACCESS_KEY,
+    "endpoint": settings.R2_ENDPOINT_URL,
+    "region": "auto",
+}
+
+# Per-workspace LanceDB handles, cached for the life of the instance. connect
+# + open_table + the FTS check each cost R2 manifest round-trips that were
+# previously paid on every request. LRU-capped so an instance serving many
+# tenants doesn't hold handles forever.
+WORKSPACE_CACHE_SIZE = int(os.getenv("WORKSPACE_CACHE_SIZE", "128"))
+_workspace_connections: OrderedDict = OrderedDict()
+_workspace_connections_lock = threading.Lock()
+# Workspaces whose open_table recently raised FileNotFoundError. Known-good
+# workspaces are already fast (handle cache hit), but repeated requests for a
+# workspace that was never indexed paid a full R2 round-trip to fail every
+# time. Short TTL, since the indexing service may create the table at any
+# moment.
+NEGATIVE_WORKSPACE_TTL_SEC = int(os.getenv("NEGATIVE_WORKSPACE_TTL_SEC", "60"))
+_negative_workspaces: dict = {}
+_negative_workspaces_lock = threading.Lock()
+
+# Workspaces whose FTS index has been confirmed this process lifetime. Kept
+# separate from the handle cache so a transient failure of the (idempotent)
+# create_fts_index call doesn't get cached as "verified" - it retries on the
+# next request for that workspace until it succeeds.
+_fts_verified: set = set()
+
+def _ensure_fts_index(table, workspace_id: str):
+    if workspace_id in _fts_verified:
+        return
+    try:
+        # Native FTS without positions: BM25 doesn't need them and the index
+        # stays smaller and faster to read.
+        table.create_fts_index("content", use_tantivy=False, with_position=False)  # no-op if it exists
+        _fts_verified.add(workspace_id)
+    except Exception as e:
+        logging.warning(f"FTS index check failed for workspace {workspace_id}: {e}")
+
+def get_workspace_db(workspace_id: str):
+    """Return (connection, table) for a workspace, connecting on first use.
+
+    Blocking (R2 round-trips on first touch) - callers on the event loop
+    should go through asyncio.to_thread. Raises FileNotFoundError if the
+    workspace has no table yet.
+    """
+    with _workspace_connections_lock:
+        cached = _workspace_connections.get(workspace_id)
+        if cached is not None:
+            _workspace_connections.move_to_end(workspace_id)
+    if cached is not None:
+        _ensure_fts_index(cached[1], workspace_id)
+        return cached
+
+    with _negative_workspaces_lock:
+        expiry = _negative_workspaces.get(workspace_id)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                raise FileNotFoundError(f"Workspace {workspace_id} has no table (cached)")
+            del _negative_workspaces[workspace_id]
+
+    # Connect outside the lock - a duplicate connect on a racing first touch
+    # is harmless, while holding the lock across R2 round-trips would
+    # serialize every cold workspace behind the slowest one.
+    workspace_db_uri = f"s3://{settings.R2_BUCKET_NAME}/{workspace_id}"
+    db_conn = lancedb.connect(workspace_db_uri, storage_options=_LANCEDB_STORAGE_OPTIONS)
+    try:
+        table = db_conn.open_table(settings.LANCEDB_TABLE_NAME)
+    except FileNotFoundError:
+        with _negative_workspaces_lock:
+            _negative_workspaces[workspace_id] = time.monotonic() + NEGATIVE_WORKSPACE_TTL_SEC
+        raise
+    _ensure_fts_index(table, workspace_id)
+
+    with _workspace_connections_lock:
+        _workspace_connections[workspace_id] = (db_conn, table)
+        _workspace_connections.move_to_end(workspace_id)
+        while len(_workspace_connections) > WORKSPACE_CACHE_SIZE:
+            _workspace_connections.popitem(last=False)
+    return db_conn, table
+
+# Firestore documents cap at ~1 MiB; an output past this threshold would fail
+# the terminal write and lose the whole answer. Leaves headroom for the other
+# job fields.
+MAX_OUTPUT_BYTES = int(os.getenv("MAX_OUTPUT_BYTES", "900000"))
+
+def _truncate_output(output: str) -> tuple[str, bool]:
+    """Clamp output to MAX_OUTPUT_BYTES of UTF-8, marking if clipped."""
+    encoded = output.encode()
+    if len(encoded) <= MAX_OUTPUT_BYTES:
+        return output, False
+    clipped = encoded[:MAX_OUTPUT_BYTES].decode(errors="ignore")
+    return clipped + "\n\n[output truncated]", True
 
 async def update_job_status(job_id: str, status: str, output: str = None, error: str = None):
     """Update job status in Firestore"""
@@ -166,18 +316,23 @@ async def update_job_status(job_id: str, status: str, output: str = None, error:
     if not firestore_client:
         logging.error(f"Job {job_id}: Firestore client not available for status update.")
         raise RuntimeError("Firestore client not available.")
-    
+
     try:
-        job_ref = firestore_client.collection(COLLECTION_ID_JOBS).document(job_id)
+        job_ref = jobs_collection.document(job_id)
         update_data = {'status': status}
-        
+
         if output is not None:
+            output, truncated = _truncate_output(output)
             update_data['output'] = output
+            if truncated:
+                logging.warning(f"Job {job_id}: output exceeded {MAX_OUTPUT_BYTES} bytes and was truncated.")
+                update_data['output_truncated'] = True
         if error is not None:
             update_data['error'] = error
-            
-        transaction = firestore_client.transaction()
-        _update_job_in_transaction(transaction, job_ref, update_data)
+
+        # A single-document update is atomic in Firestore; the transaction the
+        # old code wrapped it in bought nothing but extra round-trips.
+        await job_ref.update(update_data)
         logging.info(f"Updated job {job_id} status to {status}")
     except Exception as e:
         logging.error(f"Failed to update job {job_id} status: {e}")
@@ -194,80 +349,153 @@ def read_root():
         "status": "healthy"
     }
 
-@app.post("/")
-async def handle_cloud_task(request: Request):
-    """
-    Handle Cloud Tasks payload for async RAG queries.
+@app.get("/cache/stats")
+def cache_stats():
+    """Query-cache effectiveness counters, for dashboards and tuning."""
+    with _query_cache_lock:
+        return {**_query_cache_stats, "size": len(_query_cache), "capacity": QUERY_CACHE_SIZE}
+
+async def _process_query(payload: CloudTaskQueryPayload, agent_graph):
+    """Run the full agent pipeline for one job and record the outcome.
+
+    Runs after the 202 ack has been returned to Cloud Tasks; all outcomes -
+    success or failure - surface through the job document, never as an HTTP
+    error (a 5xx here would just make Cloud Tasks redeliver a job already
+    marked failed).
     """
+    processing_task = None
+    progress_flush = {"future": None}
+    dep_tokens = []
+
+    async def join_last_flush():
+        # Wait out the last scheduled streaming flush before any terminal
+        # write - nothing else orders the two RPCs, and a late "streaming"
+        # update landing after "completed"/"failed" would clobber the final
+        # status and answer.
+        flush = progress_flush["future"]
+        if flush is not None:
+            try:
+                await asyncio.wrap_future(flush)
+            except Exception:
+                pass  # a failed flush shouldn't block the terminal write
+
     try:
-        payload_data = await request.json()
-        payload = CloudTaskQueryPayload(**payload_data)
-        
         logging.info(f"Processing Cloud Task query for job {payload.job_id}")
-        
+
+        # Serve repeated queries straight from the cache - no LanceDB
+        # connection, no agent graph, no LLM calls.
+        cached_response = query_cache_get(payload.workspace_id, payload.query)
+        if cached_response is not None:
+            logging.info(f"Serving cached response for job {payload.job_id}")
+            await update_job_status(payload.job_id, "completed", output=cached_response)
+            return
+
         # --------------------------------------------------------------
         # Workspace-specific LanceDB connection
         # --------------------------------------------------------------
         try:
-            workspace_db_uri = f"s3://{settings.R2_BUCKET_NAME}/{payload.workspace_id}"
-            db_conn = lancedb.connect(workspace_db_uri)
-            try:
-                table = db_conn.open_table(settings.LANCEDB_TABLE_NAME)
-                # Verify/create FTS index (no-op if exists)
-                try:
-                    table.create_fts_index("content")
-                except Exception as e:
-                    logging.warning(f"FTS index check failed for workspace {payload.workspace_id}: {e}")
-            except FileNotFoundError:
-                raise HTTPException(status_code=404, detail=f"Vector index not found for workspace_id {payload.workspace_id}.")
-
-            # Expose this connection to the LangChain tools
-            dependencies.db_connection = db_conn
+            # First touch of a workspace does blocking R2 round-trips; keep
+            # them off the event loop.
+            db_conn, table = await asyncio.to_thread(get_workspace_db, payload.workspace_id)
+
+            # Expose the handles and the workspace scope to the LangChain
+            # tools. ContextVars keep them scoped to this request; concurrent
+            # requests to other workspaces can't clobber them.
+            dep_tokens.append(dependencies.db_connection_var.set(db_conn))
+            dep_tokens.append(dependencies.table_var.set(table))
+            dep_tokens.append(dependencies.workspace_id_var.set(payload.workspace_id))
+        except FileNotFoundError:
+            await update_job_status(payload.job_id, "failed", error=f"Vector index not found for workspace_id {payload.workspace_id}.")
+            return
         except Exception as e:
             logging.error(f"Failed to connect to LanceDB for workspace {payload.workspace_id}: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to connect to workspace vector store.")
+            await update_job_status(payload.job_id, "failed", error="Failed to connect to workspace vector store.")
+            return
 
-        # Ensure Firestore client is available
-        if not get_firestore_client():
-            raise HTTPException(status_code=503, detail="Firestore client not available.")
-        
-        # Update job status to processing
-        await update_job_status(payload.job_id, "processing")
-        
-        # Get agent graph from app state
-        agent_graph = request.app.state.agent_graph
-        
-        # Run the agent with workspace context
-        result = agent_graph.invoke({
+        # Update job status to processing. It's a UI-only signal, so let the
+        # write fly concurrently with the agent run instead of paying the
+        # Firestore round-trip up front; joined before the terminal write so
+        # "processing" can never land after "completed".
+        processing_task = asyncio.create_task(update_job_status(payload.job_id, "processing"))
+
+        # Stream partial summaries to the job document so the client can
+        # render the answer while it is still being generated. The summarizer
+        # runs synchronously (possibly off the event loop), so the callback
+        # schedules the async Firestore write onto the loop fire-and-forget.
+        loop = asyncio.get_running_loop()
+        job_ref = jobs_collection.document(payload.job_id)
+
+        def report_progress(partial_text: str):
+            partial_text, _ = _truncate_output(partial_text)
+            progress_flush["future"] = asyncio.run_coroutine_threadsafe(
+                job_ref.update({"status": "streaming", "output": partial_text}), loop
+            )
+
+        dep_tokens.append(dependencies.report_progress_var.set(report_progress))
+
+        # Run the agent with workspace context. The graph is a synchronous
+        # multi-second pipeline; run it on a worker thread so the event loop
+        # stays free to serve other Cloud Tasks requests (and to execute the
+        # progress flushes scheduled by report_progress).
+        result = await asyncio.to_thread(agent_graph.invoke, {
             "user_query": payload.query,
             "workspace_id": payload.workspace_id,  # Add workspace context
             "raw_code_snippets": [],
             "raw_web_results": [],
             "summarized_context": None,
             "next_action": None,
+            "hypothetical_doc": None,
         })
         
         response_text = result.get("summarized_context", "No response generated")
-        
+        query_cache_put(payload.workspace_id, payload.query, response_text)
+
+        # Join the processing write and the last streaming flush first -
+        # Firestore doesn't order independent writes. Their failures are
+        # logged where they happen; the job result shouldn't be discarded
+        # over a missed intermediate status.
+        await asyncio.gather(processing_task, return_exceptions=True)
+        await join_last_flush()
+
         # Update job status to completed with output
         await update_job_status(payload.job_id, "completed", output=response_text)
-        
+
         logging.info(f"Successfully processed query for job {payload.job_id}")
-        
-        return {"status": "success", "job_id": payload.job_id}
-        
+
     except Exception as e:
         logging.error(f"Cloud Task processing error: {e}")
-        
-        # Try to update job status to failed
+
+        # Try to update job status to failed; the client learns about the
+        # failure from the job document, not an HTTP error.
         try:
-            payload_data = await request.json()
-            payload = CloudTaskQueryPayload(**payload_data)
+            if processing_task is not None:
+                await asyncio.gather(processing_task, return_exceptions=True)
+            await join_last_flush()
             await update_job_status(payload.job_id, "failed", error=str(e))
-        except:
-            pass  # If we can't even parse the payload, log and continue
-            
-        raise HTTPException(status_code=500, detail=f"Task processing failed: {str(e)}")
+        except Exception:
+            pass  # Status write failed too; the error is already logged
+    finally:
+        for token in reversed(dep_tokens):
+            token.var.reset(token)
+
+@app.post("/", status_code=202)
+async def handle_cloud_task(payload: CloudTaskQueryPayload, request: Request, background_tasks: BackgroundTasks):
+    """
+    Handle Cloud Tasks payload for async RAG queries.
+
+    FastAPI parses and validates the body into `payload` before this runs;
+    malformed payloads get a 422 without touching the pipeline. Valid jobs
+    are acked with a 202 immediately - holding the connection open for the
+    multi-second agent run just pinned a Cloud Tasks delivery slot, and any
+    5xx would trigger a redelivery of work that already failed cleanly.
+    """
+    if not get_firestore_client():
+        # Without Firestore there is no way to report the outcome; let Cloud
+        # Tasks retry until the client initializes.
+        raise HTTPException(status_code=503, detail="Firestore client not available.")
+
+    background_tasks.add_task(_process_query, payload, request.app.state.agent_graph)
+    return {"status": "accepted", "job_id": payload.job_id}
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))